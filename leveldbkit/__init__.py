@@ -20,6 +20,10 @@
 from __future__ import absolute_import
 
 from .document import EmDocument, Document
+from .cache import LRUCache
+from .batch import Batch
+from .writebehind import WriteBehind
+from .backends import MemoryDB
 from .exceptions import *
 from .properties.standard import BaseProperty, BooleanProperty, DictProperty, EmDocumentProperty, EmDocumentsListProperty, ListProperty, NumberProperty, ReferenceProperty, StringProperty, Property
 from .properties.fancy import EnumProperty, DateTimeProperty, PasswordProperty
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""The machinery behind the asynchronous methods of Document (`aget`,
+`asave`, `adelete`, `aindex`, ...).
+
+leveldb calls block, so they are run on a thread pool dedicated to each
+Document class. The size of that pool (`Document.ASYNC_MAX_WORKERS`) is the
+maximum number of leveldb calls of that class running at the same time.
+Gets issued in the same iteration of the event loop are sent to the pool as
+a single `get_many`.
+
+Needs asyncio (or trollius on python 2) and concurrent.futures (or the
+futures backport on python 2).
+"""
+
+from __future__ import absolute_import
+
+from functools import partial
+from threading import Lock
+
+try:
+  import asyncio
+except ImportError:
+  import trollius as asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .helpers import mediocre_copy
+from .exceptions import NotFoundError
+
+try:
+  StopAsyncIteration = StopAsyncIteration
+except NameError:
+  # No async for before python 3.5, this is only raised by __anext__.
+  class StopAsyncIteration(Exception): pass
+
+_executors = {}
+_executors_lock = Lock()
+
+def get_executor(cls):
+  """Returns the thread pool of a Document class, creating it if needed."""
+  with _executors_lock:
+    executor = _executors.get(cls)
+    if executor is None:
+      executor = _executors[cls] = ThreadPoolExecutor(max_workers=cls.ASYNC_MAX_WORKERS)
+    return executor
+
+def shutdown(cls=None, wait=True):
+  """Shuts down the thread pool of a Document class, or of all the classes if
+  cls is None. A new pool is created if the class is used again."""
+  with _executors_lock:
+    if cls is None:
+      executors = _executors.values()
+      _executors.clear()
+    else:
+      executors = [_executors.pop(cls)] if cls in _executors else []
+
+  for executor in executors:
+    executor.shutdown(wait)
+
+def run(cls, fn, *args, **kwargs):
+  """Runs fn(*args, **kwargs) on the thread pool of cls.
+
+  Returns:
+    An asyncio future of the result.
+  """
+  loop = asyncio.get_event_loop()
+  return loop.run_in_executor(get_executor(cls), partial(fn, *args, **kwargs))
+
+# (cls, loop) => {(key, fields): [futures]}
+_pending_gets = {}
+
+def _load_many(cls, requests):
+  # Runs in the pool. Every waiter gets its own document.
+  results = []
+  for key, fields, count in requests:
+    try:
+      data = cls._load_data(key)
+    except NotFoundError, e:
+      results.append(e)
+      continue
+
+    docs = []
+    for i in xrange(count):
+      docs.append(cls(key).deserialize(data if i == count - 1 else mediocre_copy(data), fields))
+    results.append(docs)
+  return results
+
+def _flush_gets(cls, loop):
+  pending = _pending_gets.pop((cls, loop), {})
+  requests = sorted(pending.iterkeys())
+  waiters = [pending[request] for request in requests]
+  future = loop.run_in_executor(get_executor(cls), partial(_load_many, cls, [(key, fields, len(pending[(key, fields)])) for key, fields in requests]))
+
+  def done(future):
+    if future.cancelled() or future.exception() is not None:
+      for futures in waiters:
+        for f in futures:
+          if not f.done():
+            f.set_exception(future.exception() if not future.cancelled() else asyncio.CancelledError())
+      return
+
+    for futures, result in zip(waiters, future.result()):
+      for i, f in enumerate(futures):
+        if f.done():
+          continue
+        if isinstance(result, Exception):
+          f.set_exception(result)
+        else:
+          f.set_result(result[i])
+
+  future.add_done_callback(done)
+
+def get(cls, key, fields=None):
+  """See `Document.aget`."""
+  loop = asyncio.get_event_loop()
+  future = asyncio.Future(loop=loop)
+  fields = tuple(fields) if fields is not None else None
+
+  pending = _pending_gets.get((cls, loop))
+  if pending is None:
+    pending = _pending_gets[(cls, loop)] = {}
+    loop.call_soon(_flush_gets, cls, loop)
+
+  pending.setdefault((key, fields), []).append(future)
+  return future
+
+class AsyncDocumentIterator(object):
+  """Iterates through a generator of documents (such as `Document.index`)
+  without blocking the event loop. The generator is advanced `chunk_size`
+  documents at a time on the thread pool of the class.
+
+  Use it with `async for`, or call `__anext__` which returns a future of the
+  next document and raises StopAsyncIteration at the end. Calls to
+  `__anext__` made before the previous ones are done get the documents in
+  the order of the calls, and only one chunk is fetched at a time.
+  """
+
+  def __init__(self, cls, iterator, chunk_size=100):
+    self._cls = cls
+    self._iterator = iterator
+    self._chunk_size = chunk_size
+    self._buffer = []
+    self._exhausted = False
+    # The futures returned by __anext__ waiting for the chunk being fetched.
+    self._waiters = []
+    self._fetching = False
+    # Generators cannot be advanced from two threads at once.
+    self._iterator_lock = Lock()
+
+  def _next_chunk(self):
+    chunk = []
+    with self._iterator_lock:
+      for doc in self._iterator:
+        chunk.append(doc)
+        if len(chunk) >= self._chunk_size:
+          break
+    return chunk
+
+  def __aiter__(self):
+    return self
+
+  def __anext__(self):
+    future = asyncio.Future(loop=asyncio.get_event_loop())
+    self._waiters.append(future)
+    self._serve()
+    return future
+
+  def _serve(self):
+    # Hands out the buffered documents to the waiters in order, then fetches
+    # the next chunk if some are still waiting.
+    while self._waiters and (self._buffer or self._exhausted):
+      future = self._waiters.pop(0)
+      if future.done():
+        # Cancelled while waiting.
+        continue
+      if self._buffer:
+        future.set_result(self._buffer.pop(0))
+      else:
+        future.set_exception(StopAsyncIteration())
+
+    if self._waiters and not self._fetching:
+      self._fetching = True
+      run(self._cls, self._next_chunk).add_done_callback(self._fetched)
+
+  def _fetched(self, chunk_future):
+    self._fetching = False
+    if chunk_future.cancelled() or chunk_future.exception() is not None:
+      error = asyncio.CancelledError() if chunk_future.cancelled() else chunk_future.exception()
+      waiters, self._waiters = self._waiters, []
+      for future in waiters:
+        if not future.done():
+          future.set_exception(error)
+      return
+
+    chunk = chunk_future.result()
+    if len(chunk) < self._chunk_size:
+      self._exhausted = True
+    self._buffer.extend(chunk)
+    self._serve()
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""The storage engines `Document.db` and `Document.indexdb` can be.
+
+leveldbkit only uses the methods of `Backend` on them, which are the ones of
+`leveldb.LevelDB`. So a db can be:
+  - a `leveldb.LevelDB` (see `open_leveldb`),
+  - a `MemoryDB`, which keeps everything in memory and is much faster for
+    tests, caches and data that does not need to survive the process,
+  - a `leveldbkit.shards.ShardedDB` or a `leveldbkit.server.RemoteLevelDB`,
+  - anything else implementing `Backend`.
+"""
+
+from __future__ import absolute_import
+
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from threading import Lock
+from weakref import WeakSet
+
+try:
+  import leveldb
+except ImportError:
+  leveldb = None
+
+from .exceptions import DatabaseError
+
+class Backend(object):
+  """The interface of a storage engine. Keys and values are strings, and
+  keys are sorted bytewise."""
+
+  def Get(self, key, verify_checksums=False, fill_cache=True):
+    """Returns the value of key. Raises KeyError if there is none."""
+    raise NotImplementedError
+
+  def Put(self, key, value, sync=False):
+    raise NotImplementedError
+
+  def Delete(self, key, sync=False):
+    """Deletes key. Does nothing if there is no such key."""
+    raise NotImplementedError
+
+  def WriteBatch(self):
+    """Returns an empty write batch (with Put(key, value) and Delete(key))
+    to pass to `Write`."""
+    raise NotImplementedError
+
+  def Write(self, write_batch, sync=False):
+    """Applies all the operations of a write batch atomically."""
+    raise NotImplementedError
+
+  def RangeIter(self, key_from=None, key_to=None, include_value=True, reverse=False, verify_checksums=False, fill_cache=True):
+    """Iterates from key_from to key_to (both inclusive, None meaning the
+    first and the last key), yielding (key, value) tuples or keys if
+    include_value is False. The iteration is not affected by later writes."""
+    raise NotImplementedError
+
+  def CreateSnapshot(self):
+    """Returns an object with the Get and RangeIter of this db as it is
+    now."""
+    raise NotImplementedError
+
+  def CompactRange(self, start=None, end=None):
+    raise NotImplementedError
+
+  def GetStats(self):
+    raise NotImplementedError
+
+def open_leveldb(path, **options):
+  """Opens a `leveldb.LevelDB`, which implements `Backend`."""
+  if leveldb is None:
+    raise DatabaseError("The leveldb module is not installed.")
+  return leveldb.LevelDB(path, **options)
+
+def new_write_batch(db):
+  """Returns an empty write batch for db."""
+  factory = getattr(db, "WriteBatch", None)
+  if factory is not None:
+    return factory()
+  # leveldb.LevelDB has no WriteBatch method.
+  if leveldb is None:
+    raise DatabaseError("The leveldb module is not installed.")
+  return leveldb.WriteBatch()
+
+class MemoryWriteBatch(object):
+  def __init__(self):
+    self.ops = []
+
+  def Put(self, key, value):
+    self.ops.append((key, value))
+
+  def Delete(self, key):
+    self.ops.append((key, None))
+
+class _Pin(object):
+  # Keeps the old values a reader at seq needs while it is alive.
+  __slots__ = ("seq", "__weakref__")
+
+  def __init__(self, seq):
+    self.seq = seq
+
+def _iterate(db, pin, key_from, key_to, include_value, reverse):
+  # Walks the keys of db as they were at pin.seq, a chunk of keys at a time
+  # under the lock of db. The next chunk is found again from the last key
+  # seen, as keys may have been inserted or removed in between.
+  seq = pin.seq
+  last = None
+  size = 16
+  while True:
+    with db._lock:
+      keys = db._keys
+      if reverse:
+        if last is not None:
+          i = bisect_left(keys, last)
+        else:
+          i = len(keys) if key_to is None else bisect_right(keys, key_to)
+        chunk = keys[max(i - size, 0):i]
+        chunk.reverse()
+      else:
+        if last is not None:
+          i = bisect_right(keys, last)
+        else:
+          i = 0 if key_from is None else bisect_left(keys, key_from)
+        chunk = keys[i:i + size]
+
+      done = len(chunk) < size
+      items = []
+      for key in chunk:
+        if (key_from is not None and key < key_from) if reverse else (key_to is not None and key > key_to):
+          done = True
+          break
+        value = db._value_at(key, seq)
+        if value is not None:
+          items.append((key, value) if include_value else key)
+      if chunk:
+        last = chunk[-1]
+
+    for item in items:
+      yield item
+    if done:
+      return
+    size = min(size * 2, 1024)
+
+class _MemorySnapshot(object):
+  def __init__(self, db, seq):
+    self._db = db
+    self.seq = seq
+
+  def Get(self, key, verify_checksums=False, fill_cache=True):
+    with self._db._lock:
+      value = self._db._value_at(key, self.seq)
+    if value is None:
+      raise KeyError(key)
+    return value
+
+  def RangeIter(self, key_from=None, key_to=None, include_value=True, reverse=False, verify_checksums=False, fill_cache=True):
+    # The iterator keeps the snapshot alive.
+    return _iterate(self._db, self, key_from, key_to, include_value, reverse)
+
+class MemoryDB(Backend):
+  """A `Backend` keeping everything in memory, in a dictionary and a sorted
+  list of keys. Nothing is written to disk.
+
+  Snapshots and iterators do not copy anything. Every write gets a sequence
+  number and, while snapshots or iterators taken before it are alive, the
+  values it replaced are kept in a history for them. A key deleted while
+  they are alive stays in the list of keys until they are gone.
+  """
+
+  def __init__(self):
+    self._lock = Lock()
+    # The current values.
+    self._data = {}
+    # The keys of _data and the keys with a history, sorted.
+    self._keys = []
+    # key => [(seq, the value key had before the write seq or None)]
+    self._history = {}
+    # (seq, key) of every history entry, in order.
+    self._log = deque()
+    self._seq = 0
+    # The live snapshots and iterators, which have a seq.
+    self._pins = WeakSet()
+
+  def _value_at(self, key, seq):
+    # Called with the lock. The value of key after the writes up to seq.
+    history = self._history.get(key)
+    if history:
+      # The first write after seq replaced the value at seq.
+      i = bisect_left(history, (seq + 1, ))
+      if i < len(history):
+        return history[i][1]
+    return self._data.get(key)
+
+  def _min_seq(self):
+    if not self._pins:
+      return None
+    seqs = [pin.seq for pin in self._pins]
+    return min(seqs) if seqs else None
+
+  def _collect(self, min_seq):
+    # Drops the history no live reader needs: the values replaced by the
+    # writes up to min_seq, or all of them if there is no reader.
+    log = self._log
+    while log and (min_seq is None or log[0][0] <= min_seq):
+      seq, key = log.popleft()
+      history = self._history[key]
+      del history[0]
+      if not history:
+        del self._history[key]
+        if key not in self._data:
+          del self._keys[bisect_left(self._keys, key)]
+
+  def _set(self, key, value, seq, keep_history):
+    # Called with the lock. A value of None deletes key.
+    data = self._data
+    old = data.get(key)
+    if old is None and value is None:
+      return
+    listed = old is not None or key in self._history
+    if keep_history:
+      self._history.setdefault(key, []).append((seq, old))
+      self._log.append((seq, key))
+
+    if value is None:
+      del data[key]
+      if key not in self._history:
+        del self._keys[bisect_left(self._keys, key)]
+    else:
+      data[key] = value
+      if not listed:
+        insort(self._keys, key)
+
+  def _write(self, ops):
+    with self._lock:
+      min_seq = self._min_seq()
+      self._collect(min_seq)
+      self._seq += 1
+      for key, value in ops:
+        self._set(key, value, self._seq, min_seq is not None)
+
+  def Get(self, key, verify_checksums=False, fill_cache=True):
+    return self._data[key]
+
+  def Put(self, key, value, sync=False):
+    self._write(((key, value), ))
+
+  def Delete(self, key, sync=False):
+    self._write(((key, None), ))
+
+  def WriteBatch(self):
+    return MemoryWriteBatch()
+
+  def Write(self, write_batch, sync=False):
+    self._write(write_batch.ops)
+
+  def RangeIter(self, key_from=None, key_to=None, include_value=True, reverse=False, verify_checksums=False, fill_cache=True):
+    with self._lock:
+      pin = _Pin(self._seq)
+      self._pins.add(pin)
+    return _iterate(self, pin, key_from, key_to, include_value, reverse)
+
+  def CreateSnapshot(self):
+    with self._lock:
+      snapshot = _MemorySnapshot(self, self._seq)
+      self._pins.add(snapshot)
+    return snapshot
+
+  def CompactRange(self, start=None, end=None):
+    pass
+
+  def GetStats(self):
+    return "MemoryDB: {0} keys".format(len(self._data))
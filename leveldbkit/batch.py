@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+try:
+  import ujson as json
+except ImportError:
+  try:
+    import simplejson as json
+  except ImportError:
+    import json
+
+from contextlib import contextmanager
+from threading import Lock, RLock, Event
+
+from .exceptions import ConflictError
+from .backends import new_write_batch
+
+# Where the version of a document is stored when its class is VERSIONED.
+VERSION_KEY = "_version"
+
+class Batch(object):
+  """A set of writes to the db and indexdb of a Document class that are
+  written together when the batch is flushed.
+
+  Index changes are recorded as "add this document key to that index entry"
+  and "remove it from that one". The index entries are only read and
+  rewritten when the batch is flushed, while holding the write lock of the
+  class, so batches flushed from different threads do not overwrite each
+  other's index changes.
+
+  `Document.save(batch=True)` and friends use a batch private to the current
+  thread (flushed with `Document.flush`). A Batch can also be created and
+  passed explicitly as `batch=` to keep a set of writes apart from the others.
+  A batch can be shared between threads.
+
+  A batch can be used as a context manager (see `Document.batch`). Inside the
+  `with` block it is the batch used by batch=True in the current thread. It is
+  flushed at the end of the block, or emptied if an exception is raised.
+
+  Writes to documents of a VERSIONED class also record the version the
+  document is expected to have in the db. They are checked when the batch is
+  flushed, under the write lock, and the whole batch is discarded with a
+  ConflictError if any of them changed in the meantime.
+
+  Documents saved or deleted into a batch consider themselves written right
+  away (so saving them again into the same batch only queues what changed
+  since). If the batch is discarded instead of written, they are rolled back
+  to what they were before, so saving them again writes them.
+  """
+
+  def __init__(self, document_class, max_ops=None, max_bytes=None, sync=True, db=None):
+    """Initializes an empty batch.
+
+    Args:
+      document_class: The Document child class this batch writes to.
+      max_ops: If not None, the batch is flushed as soon as it holds this
+               many operations (document writes and index changes). Defaults
+               to None.
+      max_bytes: If not None, the batch is flushed as soon as the keys and
+                 values it holds add up to this many bytes. Defaults to None.
+      sync: sync argument to pass to leveldb when the batch is flushed
+            automatically or at the end of a with block. Defaults to True.
+      db: The db to write the documents to when the batch is flushed
+          automatically or at the end of a with block. Defaults to the class
+          db.
+    """
+    self.document_class = document_class
+    self.max_ops = max_ops
+    self.max_bytes = max_bytes
+    self.sync = sync
+    self.db = db
+    self._lock = RLock()
+    self._previous = []
+    # The number of documents being queued, which are not flushed halfway.
+    self._holding = 0
+    self._reset()
+
+  def _reset(self):
+    with self._lock:
+      self._writes = {}
+      self._index_changes = {}
+      self._versions = {}
+      # id(document) => (document, what its _write_state was before it was
+      # first queued).
+      self._documents = {}
+      self._ops = 0
+      self._bytes = 0
+
+  def clear(self):
+    """Discards all the writes in this batch. The documents queued in it are
+    rolled back (see `writing`).
+
+    Returns:
+      self
+    """
+    with self._lock:
+      self._rollback_documents()
+      self._reset()
+    return self
+
+  def _rollback_documents(self):
+    # Rolls back the documents queued in this batch, which then no longer
+    # tracks them, but keeps the writes.
+    with self._lock:
+      for doc, state in self._documents.itervalues():
+        doc._rollback(state)
+      self._documents = {}
+
+  @contextmanager
+  def writing(self, doc):
+    """A context manager to queue the writes of a document in. If the batch
+    is discarded or fails to be written, the document is rolled back with
+    its `_rollback` to what its `_write_state` was before it was first
+    queued. The batch is not flushed automatically until the writes of the
+    document are all queued.
+    """
+    with self._lock:
+      self._documents.setdefault(id(doc), (doc, doc._write_state()))
+      self._holding += 1
+      try:
+        yield
+      finally:
+        self._holding -= 1
+      self._maybe_flush()
+
+  def _queued(self, size):
+    self._ops += 1
+    self._bytes += size
+    self._maybe_flush()
+
+  def _maybe_flush(self):
+    if self._holding == 0 and \
+       ((self.max_ops is not None and self._ops >= self.max_ops) or \
+        (self.max_bytes is not None and self._bytes >= self.max_bytes)):
+      self.flush(self.sync, self.db)
+
+  def put(self, key, value):
+    """Queues storing value under key in the db."""
+    with self._lock:
+      self._writes[key] = value
+      self._queued(len(key) + len(value))
+
+  def delete(self, key):
+    """Queues deleting key from the db."""
+    with self._lock:
+      self._writes[key] = None
+      self._queued(len(key))
+
+  def add_to_index(self, index_key, key):
+    """Queues adding a document key to an index entry."""
+    with self._lock:
+      self._index_changes.setdefault(index_key, {})[key] = True
+      self._queued(len(index_key) + len(key))
+
+  def remove_from_index(self, index_key, key):
+    """Queues removing a document key from an index entry."""
+    with self._lock:
+      self._index_changes.setdefault(index_key, {})[key] = False
+      self._queued(len(index_key) + len(key))
+
+  def expect_version(self, key, version):
+    """Makes the flush fail unless the version of the document stored under
+    key is still version (None for a document that does not exist) when the
+    batch is written. Only the first expectation of a key counts, as the
+    later ones are about the writes of this batch."""
+    with self._lock:
+      self._versions.setdefault(key, version)
+
+  def merge(self, other):
+    """Adds the writes of another batch to this one, as if they were made
+    after the writes already in this batch. The other batch is not changed.
+
+    Returns:
+      self
+    """
+    with self._lock:
+      with other._lock:
+        for key, value in other._writes.iteritems():
+          self._writes[key] = value
+        for index_key, changes in other._index_changes.iteritems():
+          self._index_changes.setdefault(index_key, {}).update(changes)
+        for key, version in other._versions.iteritems():
+          self._versions.setdefault(key, version)
+        for ident, item in other._documents.iteritems():
+          self._documents.setdefault(ident, item)
+        self._ops += other._ops
+        self._bytes += other._bytes
+    return self
+
+  def get(self, key):
+    """Returns the value queued for key, or None if it is queued for deletion
+    or not written by this batch."""
+    return self._writes.get(key)
+
+  @property
+  def keys(self):
+    """The document keys written by this batch."""
+    return self._writes.keys()
+
+  def __contains__(self, key):
+    return key in self._writes
+
+  def __len__(self):
+    return self._ops
+
+  def __nonzero__(self):
+    # An empty batch is still a batch when passed as batch=.
+    return True
+
+  def __enter__(self):
+    local = self.document_class._local
+    self._previous.append(getattr(local, "batch", None))
+    local.batch = self
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.document_class._local.batch = self._previous.pop()
+    if exc_type is None:
+      self.flush(self.sync, self.db)
+    else:
+      self.clear()
+    return False
+
+  def _check_versions(self, db, written=None):
+    # Must be called with the write lock of the class. written holds the
+    # values written under the same lock by the batches checked before this
+    # one, which are not in the db yet.
+    for key, expected in self._versions.iteritems():
+      if written is not None and key in written:
+        value = written[key]
+      else:
+        try:
+          value = db.Get(key)
+        except KeyError:
+          value = None
+
+      # A document stored before versioning was turned on is at version 0.
+      version = None if value is None else json.loads(value).get(VERSION_KEY, 0)
+      if version != expected:
+        raise ConflictError("{0} is at version {1} instead of {2}.".format(key, version, expected))
+
+  def _index_write_batch(self, indexdb):
+    # Must be called with the write lock of the class.
+    write_batch = new_write_batch(indexdb)
+    changed = False
+    index_keys = sorted(self._index_changes)
+    if hasattr(indexdb, "GetMany"):
+      # One request for all the entries. See leveldbkit.server.
+      stored = indexdb.GetMany(index_keys)
+    else:
+      stored = []
+      for index_key in index_keys:
+        try:
+          stored.append(indexdb.Get(index_key))
+        except KeyError:
+          stored.append(None)
+
+    for index_key, value in zip(index_keys, stored):
+      keys = json.loads(value) if value is not None else []
+
+      present = set(keys)
+      modified = False
+      for key, add in self._index_changes[index_key].iteritems():
+        if add and key not in present:
+          keys.append(key)
+          present.add(key)
+          modified = True
+        elif not add and key in present:
+          keys.remove(key)
+          present.discard(key)
+          modified = True
+
+      if not modified:
+        continue
+
+      changed = True
+      if keys:
+        write_batch.Put(index_key, json.dumps(keys))
+      else:
+        # do some housekeeping.
+        write_batch.Delete(index_key)
+
+    return write_batch if changed else None
+
+  def flush(self, sync=True, db=None):
+    """Writes everything in this batch and empties it.
+
+    Args:
+      sync: sync argument to pass to leveldb.
+      db: The db to write the documents to. Defaults to the class db. The
+          indexes are always written to the class indexdb.
+    Raises:
+      ConflictError if a versioned document changed since it was loaded. The
+      batch is discarded (see `clear`) and nothing is written. If writing
+      fails otherwise, the batch is left as it is.
+    """
+    cls = self.document_class
+    with self._lock:
+      writes, index_changes = self._writes, self._index_changes
+      if not writes and not index_changes:
+        return
+
+      with cls._write_lock:
+        if self._versions:
+          try:
+            self._check_versions(cls._get_db(db))
+          except ConflictError:
+            self.clear()
+            raise
+
+        index_batch = None
+        if index_changes:
+          indexdb = cls._get_indexdb()
+          index_batch = self._index_write_batch(indexdb)
+
+        finish = None
+        if writes:
+          db = cls._get_db(db)
+          write_batch = new_write_batch(db)
+          for key, value in writes.iteritems():
+            if value is None:
+              write_batch.Delete(key)
+            else:
+              write_batch.Put(key, value)
+          if hasattr(db, "begin_write"):
+            # A ShardedDB, written once the write lock is released. Done
+            # last, so nothing can fail while its shards are locked.
+            if index_batch is not None:
+              indexdb.Write(index_batch, sync=sync)
+              index_batch = None
+            finish = db.begin_write(write_batch, sync)
+          else:
+            db.Write(write_batch, sync=sync)
+
+        if index_batch is not None:
+          indexdb.Write(index_batch, sync=sync)
+
+      if finish is not None:
+        finish()
+      cls._invalidate_cache(writes)
+      self._reset()
+
+
+class _Waiter(object):
+  def __init__(self, batch, db):
+    self.batch = batch
+    self.db = db
+    self.event = Event()
+    self.lead = False
+    self.error = None
+
+class GroupCommitter(object):
+  """Writes the batches of concurrent synchronous writes together.
+
+  The first thread to commit becomes the leader and writes its batch along
+  with every batch queued in the meantime with a single synced write per
+  database. The other threads wait until the write of their batch is done.
+  While the leader waits for the disk, new batches queue up and the next
+  leader writes all of them at once, so the number of syncs stays flat as
+  the number of writing threads grows.
+
+  Used by `Document` when `GROUP_COMMIT` is True.
+  """
+
+  def __init__(self, document_class):
+    self.document_class = document_class
+    self._lock = Lock()
+    self._queue = []
+    self._leader_active = False
+
+  def commit(self, batch, db=None):
+    """Writes a batch synchronously along with the other batches being
+    committed, and returns once it is written.
+
+    Args:
+      batch: the Batch to write. It is emptied once written.
+      db: The db to write the documents to. Defaults to the class db.
+    Raises:
+      Whatever error writing the group raised.
+    """
+    waiter = _Waiter(batch, db)
+    with self._lock:
+      self._queue.append(waiter)
+      lead = not self._leader_active
+      self._leader_active = True
+
+    if not lead:
+      waiter.event.wait()
+      if not waiter.lead:
+        if waiter.error is not None:
+          raise waiter.error
+        return
+
+    with self._lock:
+      group, self._queue = self._queue, []
+
+    try:
+      self._write(group)
+    finally:
+      with self._lock:
+        if self._queue:
+          # Hand over to the first one that queued up while we were writing.
+          self._queue[0].lead = True
+          self._queue[0].event.set()
+        else:
+          self._leader_active = False
+
+      for other in group:
+        if other is not waiter:
+          other.event.set()
+
+    if waiter.error is not None:
+      raise waiter.error
+
+  def _write(self, group):
+    cls = self.document_class
+    with cls._write_lock:
+      by_db = {}
+      for waiter in group:
+        by_db.setdefault(waiter.db, []).append(waiter)
+
+      for db, waiters in by_db.iteritems():
+        merged, conflicts = merge_checked(cls, [waiter.batch for waiter in waiters], db)
+        # A conflict only fails the batch that has it.
+        for waiter in waiters:
+          if waiter.batch in conflicts:
+            waiter.error = conflicts[waiter.batch]
+
+        try:
+          merged.flush(True, db)
+        except Exception, e:
+          for waiter in waiters:
+            if waiter.error is None:
+              waiter.error = e
+        else:
+          for waiter in waiters:
+            waiter.batch._reset()
+
+def merge_checked(document_class, batches, db=None):
+  """Merges batches going to the same db into one, checking the versions of
+  each batch as if the batches were written one after the other. Must be
+  called with the write lock of the class, held until the merged batch is
+  flushed.
+
+  Returns:
+    (the merged Batch, a dictionary of the batches that conflicted => their
+    ConflictError). The batches that conflicted are left out.
+  """
+  merged = Batch(document_class)
+  conflicts = {}
+  written = {}
+  for batch in batches:
+    if batch._versions:
+      try:
+        batch._check_versions(document_class._get_db(db), written)
+      except ConflictError, e:
+        conflicts[batch] = e
+        continue
+
+    written.update(batch._writes)
+    merged.merge(batch)
+
+  # Already checked against each other.
+  merged._versions = {}
+  return merged, conflicts
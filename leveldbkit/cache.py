@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from threading import Lock
+
+# How many invalidated keys the cache remembers the generation of. Past that,
+# they are forgotten all at once and the reads in progress are not cached.
+_MAX_GENERATIONS = 65536
+
+class LRUCache(object):
+  """A least recently used cache for documents read from the database.
+
+  Assign an instance of this to the `cache` class variable of a Document
+  subclass to have `get` (and `reload`) served from memory. Entries are
+  invalidated whenever the document is written through leveldbkit (`save`,
+  `delete`, `delete_key` and `flush`). Writes made to the database behind
+  leveldbkit's back are not seen by the cache.
+
+  Each class should have its own cache as the entries are keyed by the
+  document key only.
+
+  A value read from the database while the key is being invalidated must not
+  be cached, as it may be the value from before the write. Readers get the
+  `generation` of the key before reading and pass it to `put`, which ignores
+  the value if the key was invalidated since.
+  """
+
+  def __init__(self, max_entries=None, max_bytes=None, decoded=True):
+    """Initializes a new cache.
+
+    Args:
+      max_entries: The maximum number of documents to hold. None means no limit
+                   on the number of entries. Defaults to None.
+      max_bytes: The maximum total size (in bytes of the stored JSON value) of
+                 the documents to hold. None means no limit on the size.
+                 Defaults to None.
+      decoded: If True, the JSON decoded data is cached and the JSON decoding
+               is skipped on a hit. Otherwise the raw stored value is cached,
+               which uses less memory but still needs to be decoded on every
+               hit. Defaults to True.
+    """
+    if max_entries is None and max_bytes is None:
+      raise ValueError("LRUCache needs at least one of max_entries or max_bytes.")
+
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.decoded = decoded
+
+    self._entries = OrderedDict()
+    self._size = 0
+    self._lock = Lock()
+    # The generation of the keys invalidated lately, and the generation of
+    # all the others.
+    self._generations = {}
+    self._generation = 0
+    self._floor = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    """Gets an entry from the cache and marks it as the most recently used.
+
+    Args:
+      key: the document key
+    Returns:
+      The cached value (decoded data or raw value depending on `decoded`), or
+      None if the key is not cached.
+    """
+    with self._lock:
+      try:
+        value, size = self._entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return None
+
+      self._entries[key] = (value, size)
+      self.hits += 1
+      return value
+
+  def generation(self, key):
+    """Returns the generation of a key, which changes every time the key is
+    invalidated. Get it before reading the value to `put`.
+
+    Args:
+      key: the document key
+    """
+    with self._lock:
+      return self._generations.get(key, self._floor)
+
+  def put(self, key, value, size, generation=None):
+    """Puts an entry into the cache, evicting the least recently used entries
+    if the cache is over its limits.
+
+    Args:
+      key: the document key
+      value: the value to cache
+      size: the size of the raw stored value in bytes
+      generation: The `generation` of the key before value was read. If the
+                  key was invalidated since, value may be stale and is not
+                  cached. None means it is cached regardless. Defaults to None.
+    """
+    if self.max_bytes is not None and size > self.max_bytes:
+      return
+
+    with self._lock:
+      if generation is not None and self._generations.get(key, self._floor) != generation:
+        return
+
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self._size -= old[1]
+
+      self._entries[key] = (value, size)
+      self._size += size
+
+      while (self.max_entries is not None and len(self._entries) > self.max_entries) or \
+            (self.max_bytes is not None and self._size > self.max_bytes):
+        _, (_, evicted_size) = self._entries.popitem(last=False)
+        self._size -= evicted_size
+        self.evictions += 1
+
+  def invalidate(self, key):
+    """Removes a key from the cache if it is there, and changes its
+    generation."""
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self._size -= old[1]
+
+      self._generation += 1
+      if len(self._generations) >= _MAX_GENERATIONS:
+        self._forget_generations()
+      else:
+        self._generations[key] = self._generation
+
+  def _forget_generations(self):
+    # Must be called with the lock. Every key gets the new generation.
+    self._generations.clear()
+    self._floor = self._generation
+
+  def clear(self):
+    """Removes everything from the cache. The counters are not reset."""
+    with self._lock:
+      self._entries.clear()
+      self._size = 0
+      self._generation += 1
+      self._forget_generations()
+
+  def reset_stats(self):
+    """Resets the hit, miss and eviction counters."""
+    with self._lock:
+      self.hits = self.misses = self.evictions = 0
+
+  def stats(self):
+    """Returns a dictionary of the current counters and size of the cache,
+    useful when sizing it."""
+    with self._lock:
+      total = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "hit_ratio": float(self.hits) / total if total else 0.0,
+        "entries": len(self._entries),
+        "bytes": self._size,
+      }
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
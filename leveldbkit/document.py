@@ -28,12 +28,22 @@ except ImportError:
 
 from uuid import uuid1
 from copy import copy
+from random import uniform
+from time import sleep
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import Pool
+from threading import local, Lock, RLock
+import os.path
 
 from .properties.standard import BaseProperty, StringProperty, NumberProperty, ReferenceProperty, ListProperty
-from .helpers import walk_parents
-from .exceptions import ValidationError, NotFoundError, DatabaseError
+from .helpers import walk_parents, mediocre_copy
+from .exceptions import ValidationError, NotFoundError, DatabaseError, ConflictError
+from .batch import Batch, GroupCommitter, VERSION_KEY
+from .backends import new_write_batch
+from .shards import ShardedDB
+from . import handles
 
-from leveldb import WriteBatch, LevelDB
 
 class EmDocumentMetaclass(type):
   def __new__(cls, clsname, parents, attrs):
@@ -309,7 +319,7 @@ class EmDocument(object):
     if name in self._data:
       if name in self._props_to_load:
         self._data[name] = self._meta[name].from_db(self._data[name])
-        self._prop_to_load.discard(name)
+        self._props_to_load.discard(name)
       return self._data[name]
     self._attribute_not_found(name)
 
@@ -326,84 +336,459 @@ class EmDocument(object):
   __getitem__ = __getattr__
   __delitem__ = __delattr__
 
+class _WriteLock(object):
+  # The write lock of an indexdb (or of a db if the class has no indexdb),
+  # held while index entries are read and rewritten. A reentrant lock of this
+  # process which, if the database is served by a leveldbkit.server.Server,
+  # also holds the lock of the server for it so the other processes wait as
+  # well.
+
+  def __init__(self, remote=None):
+    # The RemoteLevelDB to take the server lock of, if any.
+    self._db = remote
+    self._lock = RLock()
+    self._depth = 0
+    self._remote = None
+
+  def __enter__(self):
+    self._lock.acquire()
+    if self._depth == 0:
+      remote = self._db
+      if remote is not None:
+        try:
+          remote.lock()
+        except:
+          self._lock.release()
+          raise
+      self._remote = remote
+    self._depth += 1
+    return self
+
+  def __exit__(self, *exc_info):
+    self._depth -= 1
+    try:
+      if self._depth == 0 and self._remote is not None:
+        remote, self._remote = self._remote, None
+        remote.unlock()
+    finally:
+      self._lock.release()
+
+# The key of a database in _write_locks => its _WriteLock.
+_write_locks = {}
+_write_locks_lock = Lock()
+
+def _write_lock_key(db):
+  # The same database must get the same key however it is referred to: by
+  # path, by a lease of the handle pool or by the handle itself.
+  if isinstance(db, basestring):
+    return os.path.abspath(db)
+  if isinstance(db, handles.Lease):
+    db = db.db
+  path = handles.pool.path_of(db)
+  if path is not None:
+    return path
+  if hasattr(db, "lock"):
+    # A RemoteLevelDB, equal to the others for the same server database.
+    return db
+  return id(db)
+
 class DocumentMetaclass(EmDocumentMetaclass):
   def __new__(cls, clsname, parents, attrs):
-    attrs["_write_batch"] = WriteBatch()
-    attrs["_index_write_needed"] = False
+    # Batches and snapshots are per thread.
+    attrs["_local"] = local()
+
+    new_cls = EmDocumentMetaclass.__new__(cls, clsname, parents, attrs)
+    new_cls._write_lock_of = (None, None)
+    new_cls._group_committer = GroupCommitter(new_cls)
+    if attrs.get("shards"):
+      new_cls.db = ShardedDB(new_cls.shards, new_cls.db_options, new_cls.OPEN_ONLY_WHEN_NEEDED, new_cls.HANDLE_IDLE_TIMEOUT)
+    return new_cls
+
+  @property
+  def _write_lock(cls):
+    """The lock held while index entries are read and rewritten. It belongs
+    to the indexdb (or to the db if there is no indexdb), so all the classes
+    writing to the same indexdb share it."""
+    db = getattr(cls, "indexdb", None) or getattr(cls, "db", None)
+    cached_db, lock = cls._write_lock_of
+    if lock is None or cached_db is not db:
+      key = _write_lock_key(db)
+      with _write_locks_lock:
+        lock = _write_locks.get(key)
+        if lock is None:
+          lock = _write_locks[key] = _WriteLock(db if hasattr(db, "lock") else None)
+      cls._write_lock_of = (db, lock)
+    return lock
 
-    attrs["_indexdb_write_batch"] = WriteBatch()
+_INDEX_KEY = "{f}~{v}"
 
-    return EmDocumentMetaclass.__new__(cls, clsname, parents, attrs)
+def _aio():
+  # asyncio is optional (it needs trollius and futures on python 2), so it is
+  # only imported when the asynchronous API is used.
+  from . import aio
+  return aio
+
+def _chunks(iterable, size):
+  iterator = iter(iterable)
+  while True:
+    chunk = list(islice(iterator, size))
+    if not chunk:
+      return
+    yield chunk
+
+def _prefix_end(prefix):
+  """Returns the smallest key that is greater than all the keys starting with
+  prefix, or None if there is no such key."""
+  prefix = prefix.rstrip("\xff")
+  if not prefix:
+    return None
+  return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+# Runs in the worker processes of Document.parallel_map, so it needs to be
+# importable at the module level.
+def _map_chunk(args):
+  cls, fn, fields, chunk = args
+  return [fn(cls(key).deserialize(json.loads(value), fields)) for key, value in chunk]
+
+def _expand_references(level, expand):
+  """Replaces the keys of reference properties in serialized documents with
+  the serialized referenced documents, breadth first.
+
+  A document referenced more than once in a level is fetched and serialized
+  once, but every reference gets its own copy of the result.
+
+  Args:
+    level: A list of (document, serialized dictionary) tuples.
+    expand: The list of serialize arguments for each level. See
+            `Document.serialize`.
+  """
+  to_dump = []
+  # The references to a document already serialized in their level.
+  shared = []
+  for kwargs in expand:
+    kwargs = dict(kwargs)
+    kwargs.pop("expand", None)
+    as_dictionary = kwargs.pop("dictionary", True)
+
+    # (serialized dictionary, name, reference class, key or document)
+    references = []
+    keys_to_fetch = {}
+    for doc, d in level:
+      for name, prop in doc._meta.iteritems():
+        if not isinstance(prop, ReferenceProperty) or d.get(name) is None:
+          continue
+
+        value = doc._data[name]
+        if name in doc._props_to_load or isinstance(value, basestring):
+          keys_to_fetch.setdefault(prop.reference_class, set()).add(value)
+        elif value._pending_load:
+          keys_to_fetch.setdefault(prop.reference_class, set()).add(value.key)
+          value = value.key
+        references.append((d, name, prop, value))
+
+    fetched = {}
+    for reference_class, keys in keys_to_fetch.iteritems():
+      fetched[reference_class] = reference_class.get_many(keys)
+
+    serialized = {}
+    next_level = []
+    for d, name, prop, value in references:
+      if isinstance(value, basestring):
+        ident = (prop.reference_class, value)
+        value = fetched[prop.reference_class].get(value)
+        if value is None:
+          if prop.strict:
+            raise NotFoundError("{0} not found".format(ident[1]))
+          d[name] = None
+          continue
+      else:
+        ident = id(value)
 
-_INDEX_KEY = "{f}~{v}"
+      if ident not in serialized:
+        serialized[ident] = value.serialize(**kwargs)
+        next_level.append((value, serialized[ident]))
+      else:
+        shared.append((d, name))
+
+      d[name] = serialized[ident]
+      if not as_dictionary:
+        to_dump.append((d, name))
+
+    level = next_level
+
+  # Dump the deepest levels first so their parents contain the json strings.
+  for d, name in reversed(to_dump):
+    d[name] = json.dumps(d[name])
+
+  # Copied once fully expanded, the deepest levels first so the copies of
+  # their parents do not share them either.
+  for d, name in reversed(shared):
+    if isinstance(d[name], dict):
+      d[name] = mediocre_copy(d[name])
 
 class Document(EmDocument):
   """The base Document class for custom classes to extend from.
   There are a couple of class variables that's required for this to work:
-    - `db`: a `leveldb.LevelDB` instance that points to the database.
+    - `db`: a `leveldb.LevelDB` instance that points to the database, or
+            any other `leveldbkit.backends.Backend` such as a
+            `leveldbkit.backends.MemoryDB`.
+    - `shards`: instead of `db`, a list of paths (or `leveldb.LevelDB`
+                instances) to spread the documents over by the hash of their
+                key. The indexes stay in the one `indexdb`. Iterations merge
+                the shards in key order. Writes are only atomic within a
+                shard, the shards are written in parallel. With
+                OPEN_ONLY_WHEN_NEEDED the paths are only opened while they
+                are used. See `leveldbkit.shards`.
     - `indexdb`: a dictionary: 2i field => `leveldb.LevelDB` instance.
     - `OPEN_ONLY_WHEN_NEEDED`: This indicates that `db` and `indexdb` are paths
                                to the database and it will only open when we
                                write (no more locks! although race conditions)
                                At the end of the day I'm gonna write a leveldb
                                server based off of https://github.com/srinikom/leveldb-server
+    - `HANDLE_IDLE_TIMEOUT`: With OPEN_ONLY_WHEN_NEEDED, how long (in
+                             seconds) a database stays open after it was last
+                             used, so that consecutive operations do not
+                             reopen it. Databases are shared by path between
+                             classes. 0 closes them as soon as the operation
+                             is done. See `leveldbkit.handles`. Defaults to 0.
+    - `db_options`, `indexdb_options`: optional dictionaries of options to open
+                                       `db` and `indexdb` with when they are
+                                       paths, such as
+                                       {"block_cache_size": 64 << 20,
+                                        "write_buffer_size": 16 << 20}.
+                                       See `leveldbkit.handles.open_db`.
+    - `cache`: an optional `leveldbkit.cache.LRUCache` instance. If set, `get`
+               and `reload` from the class db will be served from it.
+    - `ASYNC_MAX_WORKERS`: The size of the thread pool that runs the leveldb
+                           calls of the asynchronous methods (`aget`, `asave`,
+                           ...) of this class. Defaults to 4.
+    - `GROUP_COMMIT`: If True, concurrent `save` and `delete` with sync=True
+                      (and batch=False) from different threads are written
+                      together with a single synced write. See
+                      `leveldbkit.batch.GroupCommitter`. Defaults to False.
+    - `TRACK_CHANGES`: If True, documents remember what they looked like in
+                       the database when they are loaded or saved, and `save`
+                       only validates, converts and reindexes the properties
+                       that changed since. Saving a document that has not
+                       changed only reads the stored value, and writes
+                       nothing if it is still what the document was loaded
+                       or saved as. Only the list and dict values are copied
+                       for that, so loading stays cheap; set it to False to
+                       avoid even that for read heavy classes. Defaults to
+                       True.
+    - `VERSIONED`: If True, a version number is stored with every document
+                   (under "_version") and incremented on every write. `save`
+                   and `delete` raise `ConflictError` if the document was
+                   written by someone else since it was loaded, instead of
+                   silently overwriting the other write. See `mutate`.
+                   Defaults to False.
+    - `write_behind`: an optional `leveldbkit.writebehind.WriteBehind`
+                      instance. If set, the writes that are not batch=True
+                      are queued and written by a background thread. The
+                      writes that read the stored documents first wait for
+                      the queued writes to be written. `update`,
+                      `update_many` and `mutate` then write right away, the
+                      deletes are queued.
+    - `AUTO_COMPACT_AFTER`: If not None, `delete_where` and `delete_range`
+                            compact the range they deleted, and
+                            `rebuild_indexes` the indexdb, when they touched
+                            at least this many documents. See `compact`.
+                            Defaults to None.
   """
   __metaclass__ = DocumentMetaclass
 
   OPEN_ONLY_WHEN_NEEDED = False
+  HANDLE_IDLE_TIMEOUT = 0
+  shards = None
+  db_options = None
+  indexdb_options = None
+  cache = None
+  write_behind = None
+  ASYNC_MAX_WORKERS = 4
+  GROUP_COMMIT = False
+  TRACK_CHANGES = True
+  VERSIONED = False
+  AUTO_COMPACT_AFTER = None
 
   @classmethod
   def establish_connection(cls):
     """If you didn't specify a LevelDB instance and just a path, use this to
     open a connection if OPEN_ONLY_WHEN_NEEDED is False. (It will also set it
     to False). Calling this multiple times will not be bad as this checks if
-    cls.db/indexdb is a basestring or not.
+    cls.db/indexdb is a basestring or not. Classes with the same paths share
+    the databases.
     """
+    # Kept open until handles.pool.close, so the databases themselves are
+    # used rather than leases.
     if hasattr(cls, "db") and isinstance(cls.db, basestring):
-      cls.db = LevelDB(cls.db)
+      cls.db = handles.pool.get(cls.db, None, cls.db_options).db
+    elif isinstance(getattr(cls, "db", None), ShardedDB):
+      cls.db.open()
 
     if hasattr(cls, "indexdb") and isinstance(cls.indexdb, basestring):
-      cls.indexdb = LevelDB(cls.indexdb)
+      cls.indexdb = handles.pool.get(cls.indexdb, None, cls.indexdb_options).db
 
     cls.OPEN_ONLY_WHEN_NEEDED = False
 
+  @classmethod
+  def _open(cls, db, options):
+    if cls.OPEN_ONLY_WHEN_NEEDED and isinstance(db, basestring):
+      return handles.pool.get(db, cls.HANDLE_IDLE_TIMEOUT, options)
+    return db
+
   @classmethod
   def _get_indexdb(cls):
-    return LevelDB(cls.indexdb) if cls.OPEN_ONLY_WHEN_NEEDED else cls.indexdb
+    return cls._open(cls.indexdb, cls.indexdb_options)
 
   @classmethod
   def _get_db(cls, db=None):
-    db = db or cls.db
-    return LevelDB(db) if cls.OPEN_ONLY_WHEN_NEEDED else db
+    return cls._open(db or cls.db, cls.db_options)
+
+  @classmethod
+  def _get_reader(cls):
+    """Returns what the class db should be read from: the current snapshot
+    if there is one, otherwise the db."""
+    snapshot = getattr(cls._local, "snapshot", None)
+    return snapshot[0] if snapshot is not None else cls._get_db()
+
+  @classmethod
+  def _get_index_reader(cls):
+    snapshot = getattr(cls._local, "snapshot", None)
+    return snapshot[1] if snapshot is not None else cls._get_indexdb()
 
   @classmethod
-  def _flush_indexes(cls, sync=True):
-    if cls._index_write_needed:
-      cls._get_indexdb().Write(cls._indexdb_write_batch, sync=sync)
-      cls._indexdb_write_batch = WriteBatch()
-      cls._index_write_needed = False
+  @contextmanager
+  def snapshot(cls):
+    """A context manager in which all the reads of this class from the class
+    db and indexdb (`get`, `get_many`, `reload`, `index`, `index_keys_only`,
+    ...) see the databases as they were when the context was entered. Writes
+    inside the context go to the databases as usual and are not visible to
+    these reads. Nested contexts share the outer snapshot.
+
+    The snapshot only applies to the current thread. The cache is bypassed
+    while it is active.
+    """
+    if getattr(cls._local, "snapshot", None) is not None:
+      yield
+      return
+
+    indexdb = getattr(cls, "indexdb", None)
+    cls._local.snapshot = (
+      cls._get_db().CreateSnapshot(),
+      cls._get_indexdb().CreateSnapshot() if indexdb else None
+    )
+    try:
+      yield
+    finally:
+      cls._local.snapshot = None
+
+  @classmethod
+  def _invalidate_cache(cls, keys):
+    if cls.cache is not None:
+      for key in keys:
+        cls.cache.invalidate(key)
+
+  @classmethod
+  def _load_data(cls, key, verify_checksums=False, fill_cache=True, db=None):
+    """Gets the JSON decoded data stored under key, going through the cache
+    if the read is from the class db."""
+    cache = None
+    if db is None:
+      cache = cls.cache if getattr(cls._local, "snapshot", None) is None else None
+      db = cls._get_reader()
+    else:
+      db = cls._get_db(db)
+
+    if cache is not None:
+      cached = cache.get(key)
+      if cached is not None:
+        return mediocre_copy(cached) if cache.decoded else json.loads(cached)
+      # Taken before reading, so a write in between keeps the value read out.
+      generation = cache.generation(key)
+
+    try:
+      value = db.Get(key, verify_checksums, fill_cache)
+    except KeyError:
+      raise NotFoundError("{0} not found".format(key))
+
+    data = json.loads(value)
+    if cache is not None:
+      cache.put(key, mediocre_copy(data) if cache.decoded else value, len(value), generation)
+    return data
+
+  @classmethod
+  def _current_batch(cls):
+    """Returns the batch of the current thread, used by batch=True."""
+    batch = getattr(cls._local, "batch", None)
+    if batch is None:
+      batch = cls._local.batch = Batch(cls)
+    return batch
+
+  @classmethod
+  def _batch_for(cls, batch):
+    # The batch a write goes to: an explicit Batch, the batch of the current
+    # thread for batch=True, or a new batch that is flushed right away.
+    if isinstance(batch, Batch):
+      return batch
+    return cls._current_batch() if batch else Batch(cls)
+
+  @classmethod
+  def batch(cls, max_ops=None, max_bytes=None, sync=True, db=None):
+    """Creates a batch to be used as a context manager. Inside the with block,
+    the writes with batch=True of the current thread go to this batch, which
+    is flushed whenever it reaches max_ops operations or max_bytes bytes,
+    flushed at the end of the block and discarded if an exception is raised:
+
+      with User.batch(max_ops=5000, max_bytes=8 << 20, sync=False):
+        for user in users:
+          user.save(batch=True)
+
+    Args:
+      See `Batch`.
+    Returns:
+      A `Batch`.
+    """
+    return Batch(cls, max_ops, max_bytes, sync, db)
+
+  @classmethod
+  def _commit(cls, batch, sync=True, db=None, queue=True):
+    """Writes a batch that is not a batch=True one, through the write behind
+    queue (unless queue is False) or the group commit if they are enabled. If
+    it fails, the batch is discarded and its documents rolled back."""
+    try:
+      if queue and cls.write_behind is not None:
+        cls.write_behind.put(batch, db)
+      elif sync and cls.GROUP_COMMIT:
+        cls._group_committer.commit(batch, db)
+      else:
+        batch.flush(sync, db)
+    except:
+      batch.clear()
+      raise
+
+  @classmethod
+  def _wait_for_writes(cls):
+    # The stored values do not include the writes still queued for the write
+    # behind thread, the writes that read them wait for those first.
+    if cls.write_behind is not None:
+      cls.write_behind.wait()
 
   @classmethod
   def flush(cls, sync=True, db=None):
-    """Flushes all the batch operations.
+    """Flushes all the batch operations of the current thread.
 
     Args:
       sync: sync argument to pass to leveldb.
       db: The db to write to. Defaults to the default class database. The index
           dbs will not be affected.
     """
-    db = db or cls._get_db()
-    db.Write(cls._write_batch, sync=sync)
-    cls._write_batch = WriteBatch()
-    cls._flush_indexes(sync)
+    cls._current_batch().flush(sync, db)
 
   @classmethod
   def reset_write_batch(cls):
-    """Empties the current write batch.
+    """Empties the current write batch of the current thread.
     This means all the current writes are void"""
-    cls._write_batch = WriteBatch()
-    cls._indexdb_write_batch = WriteBatch()
-    cls._index_write_needed = False
+    cls._current_batch().clear()
 
   def __init__(self, key=lambda: uuid1().hex, data={}, db=None):
     """Creates a new instance of a document.
@@ -423,12 +808,20 @@ class Document(EmDocument):
       raise TypeError("Key must be a string (offender: {0}).".format(key))
 
     self.__dict__["key"] = key
+    self.__dict__["_pending_load"] = False
+    # The stored (serialized) data as of the last load or save, or None if
+    # unknown, and the names of the attributes set since.
+    self.__dict__["_clean"] = None
+    self.__dict__["_dirty"] = set()
     EmDocument.__init__(self, data)
     self.__dict__["db"] = db
     self.__dict__["_old_indexes"] = {}
+    self.__dict__["_partial"] = None
+    # The stored version when VERSIONED, None if not stored yet.
+    self.__dict__["_version"] = None
 
   @classmethod
-  def get(cls, key, verify_checksums=False, fill_cache=True, db=None):
+  def get(cls, key, verify_checksums=False, fill_cache=True, db=None, fields=None):
     """Gets a document from the database given a key.
 
     Args:
@@ -437,13 +830,126 @@ class Document(EmDocument):
       fill_cache: See pyleveldb's documentation
       db: A `leveldb.LevelDB` instance to get from. Defaults to the object/class
           db.
+      fields: If not None, a list of property names to load. Only these are
+              converted from the database and the document is read only. See
+              `reload`. Defaults to None.
     Returns:
       The document associated with that key.
     Raises:
       NotFoundError: when the key is not found in db.
     """
     doc = cls(key=key, db=db)
-    return doc.reload(verify_checksums, fill_cache, db)
+    return doc.reload(verify_checksums, fill_cache, db, fields)
+
+  @classmethod
+  def lazy(cls, key, db=None):
+    """Creates a document that is only fetched from the database when one of
+    its attributes is first accessed (or when it is serialized, validated,
+    saved or deleted). This is what lazy `ReferenceProperty` values are.
+
+    Args:
+      key: the key of the document.
+      db: A `leveldb.LevelDB` instance to get from. Defaults to the class db.
+    Returns:
+      A document that is not loaded yet.
+    """
+    doc = cls(key=key, db=db)
+    doc.__dict__["_pending_load"] = True
+    return doc
+
+  @classmethod
+  def get_many(cls, keys, verify_checksums=False, fill_cache=True, db=None, fields=None):
+    """Gets many documents from the database. Duplicated keys are only
+    fetched once and the keys are fetched in sorted order so neighbouring
+    documents are read from the same blocks.
+
+    Args:
+      keys: an iterable of keys to get.
+      verify_checksums: See pyleveldb's documentation
+      fill_cache: See pyleveldb's documentation
+      db: A `leveldb.LevelDB` instance to get from. Defaults to the class db.
+      fields: See `get`.
+    Returns:
+      A dictionary of key => document. Keys that are not found are not in the
+      dictionary.
+    """
+    docs = {}
+    keys = sorted(set(keys))
+    reader = cls._get_reader() if db is None else cls._get_db(db)
+    if cls.cache is None and hasattr(reader, "GetMany"):
+      # One request for all of them. See leveldbkit.server.
+      for key, value in zip(keys, reader.GetMany(keys)):
+        if value is not None:
+          docs[key] = cls(key=key, db=db).deserialize(json.loads(value), fields)
+      return docs
+
+    for key in keys:
+      try:
+        data = cls._load_data(key, verify_checksums, fill_cache, db)
+      except NotFoundError:
+        continue
+      docs[key] = cls(key=key, db=db).deserialize(data, fields)
+    return docs
+
+  @classmethod
+  def prefetch_related(cls, docs, *fields):
+    """Fetches the documents referenced by `ReferenceProperty` fields for a
+    list of documents at once rather than one at a time when each of them is
+    accessed. Only the references not fetched yet, that is of lazy or
+    load_on_demand properties, are fetched. Documents referencing the same key
+    will share the fetched document.
+
+    Args:
+      docs: A list of documents of this class.
+      fields: The names of the reference properties to fetch.
+    Returns:
+      docs
+    Raises:
+      NotFoundError if a referenced document does not exist and the property
+      is strict. Otherwise, the missing reference becomes None.
+    """
+    docs = list(docs)
+    for field in fields:
+      prop = cls._meta.get(field)
+      if not isinstance(prop, ReferenceProperty):
+        raise ValueError("'{0}' is not a ReferenceProperty of '{1}'.".format(field, cls.__name__))
+
+      pending = []
+      for doc in docs:
+        doc._ensure_loaded()
+        value = doc._data.get(field)
+        if field in doc._props_to_load:
+          doc._props_to_load.discard(field)
+          key = value
+        elif isinstance(value, Document) and value._pending_load:
+          key = value.key
+        else:
+          continue
+
+        if key is not None:
+          pending.append((doc, key))
+        else:
+          doc._data[field] = None
+
+      fetched = prop.reference_class.get_many(key for _, key in pending)
+      for doc, key in pending:
+        if key in fetched:
+          doc._data[field] = fetched[key]
+        elif prop.strict:
+          raise NotFoundError("{0} not found".format(key))
+        else:
+          doc._data[field] = None
+
+    return docs
+
+  def _ensure_loaded(self):
+    if self._pending_load:
+      self._pending_load = False
+      try:
+        self.reload()
+      except:
+        self._pending_load = True
+        raise
 
   @classmethod
   def get_or_new(cls, key, verify_checksums=False, fill_cache=True, db=None):
@@ -487,28 +993,45 @@ class Document(EmDocument):
     cls._ensure_indexdb_exists(field)
 
     if field == "$bucket":
-      return [key for key, _ in cls.db.RangeIter()]
+      return list(cls._get_reader().RangeIter(include_value=False))
     if field == "$key":
-      return [key for key, _ in cls.db.RangeIter(start_value, end_value)]
+      return list(cls._get_reader().RangeIter(start_value, end_value, include_value=False))
+
+    return list(cls._iter_index_keys(field, start_value, end_value))
+
+  @classmethod
+  def _iter_index_keys(cls, field, start_value, end_value=None):
+    # The document keys of an index lookup on a real field, read one index
+    # entry at a time.
+    for index_key, key in cls._iter_index_items(field, start_value, end_value):
+      yield key
 
+  @classmethod
+  def _iter_index_items(cls, field, start_value, end_value=None):
+    # Same as _iter_index_keys, with the index entry of every key:
+    # (index key, document key) tuples.
     if isinstance(cls._meta[field], NumberProperty):
       start_value = float(start_value)
       if end_value is not None:
         end_value = float(end_value)
 
     if end_value is None:
+      index_key = _INDEX_KEY.format(f=field, v=start_value)
       try:
-        return json.loads(cls._get_indexdb().Get(_INDEX_KEY.format(f=field, v=start_value)))
+        keys = json.loads(cls._get_index_reader().Get(index_key))
       except KeyError:
-        return []
+        keys = []
+      for key in keys:
+        yield index_key, key
     else:
-      all_keys = []
-      for index_value, keys in cls._get_indexdb().RangeIter(_INDEX_KEY.format(f=field, v=start_value), _INDEX_KEY.format(f=field, v=end_value)):
-        all_keys.extend(keys)
-      return all_keys
+      # Keeps the indexdb in use while iterating. See leveldbkit.handles.
+      reader = cls._get_index_reader()
+      for index_key, keys in reader.RangeIter(_INDEX_KEY.format(f=field, v=start_value), _INDEX_KEY.format(f=field, v=end_value)):
+        for key in json.loads(keys):
+          yield index_key, key
 
   @classmethod
-  def index(cls, field, start_value, end_value=None):
+  def index(cls, field, start_value, end_value=None, fields=None):
     """Index lookup. Given a field and a value, find the associated documents
 
     Args:
@@ -517,6 +1040,8 @@ class Document(EmDocument):
       end_value: if not None, this is a ranged search, that is, all document with
                  of field and value between start_value and end_value will be
                  returned
+      fields: If not None, only load these properties of the documents. See
+              `reload`. Defaults to None.
     Returns:
       A generator that iterates through all the documents
 
@@ -526,39 +1051,134 @@ class Document(EmDocument):
     cls._ensure_indexdb_exists(field)
 
     if field == "$bucket":
-      for key, _ in cls.db.RangeIter():
-        yield cls(key).reload()
+      for doc in cls.scan(fields=fields):
+        yield doc
     elif field == "$key":
-      for key, _ in cls.db.RangeIter(start_value, end_value):
-        yield cls(key).reload()
+      for doc in cls.scan(start_value, end_value, fields=fields):
+        yield doc
     else:
-      if isinstance(cls._meta[field], NumberProperty):
-        start_value = float(start_value)
-        if end_value is not None:
-          end_value = float(end_value)
+      for key in cls._iter_index_keys(field, start_value, end_value):
+        yield cls(key).reload(fields=fields)
 
-      if end_value is None:
-        try:
-          keys = json.loads(cls._get_indexdb().Get(_INDEX_KEY.format(f=field, v=start_value)))
-        except KeyError:
-          keys = []
+  @classmethod
+  def scan(cls, start=None, end=None, fields=None):
+    """Iterates through the documents in the class db in key order. The
+    documents are built from the values read by the iterator, so there is
+    one read per document. To spread the work of a large scan over several
+    processes, see `parallel_map`.
+
+    Args:
+      start: the first key (inclusive). Defaults to the beginning of the db.
+      end: the last key (inclusive). Defaults to the end of the db.
+      fields: If not None, only load these properties. See `reload`.
+    Returns:
+      A generator that iterates through the documents.
+    """
+    return cls.iter_range(start, end, fields=fields)
+
+  @classmethod
+  def parallel_map(cls, fn, workers=None, start=None, end=None, fields=None, chunk_size=1000):
+    """Calls fn on every document between start and end using a pool of
+    processes, and returns the results.
+
+    The key range is cut into consecutive partitions of chunk_size documents,
+    so every partition is the same amount of work regardless of how the keys
+    are distributed. leveldb only lets one process open a database, so the
+    partitions are read by this process and streamed to the workers, which
+    do the JSON decoding, the conversion of the properties and fn.
+
+    Args:
+      fn: A function taking a document. It and its return value need to be
+          picklable, so it has to be defined at the module level.
+      workers: The number of processes. Defaults to the number of CPUs.
+      start: the first key (inclusive). Defaults to the beginning of the db.
+      end: the last key (inclusive). Defaults to the end of the db.
+      fields: If not None, only load these properties. See `reload`.
+      chunk_size: The number of documents per partition. Defaults to 1000.
+    Returns:
+      A list of the return values of fn, in key order.
+    """
+    reader = cls._get_reader()
+    items = reader.RangeIter(start, end)
+    tasks = ((cls, fn, fields, chunk) for chunk in _chunks(items, chunk_size))
+
+    results = []
+    pool = Pool(workers)
+    try:
+      for chunk_results in pool.imap(_map_chunk, tasks):
+        results.extend(chunk_results)
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+
+    return results
 
-        for key in keys:
-          yield cls(key).reload()
+  @classmethod
+  def iter_range(cls, start=None, end=None, prefix=None, limit=None, reverse=False, keys_only=False, include_value=True, fields=None):
+    """Iterates through the class db by key, as leveldb does.
+
+    Args:
+      start: the first key (inclusive). Defaults to the beginning of the db.
+      end: the last key (inclusive). Defaults to the end of the db.
+      prefix: If not None, only keys starting with this are iterated. It can
+              be combined with start and end. Defaults to None.
+      limit: If not None, the maximum number of items to yield.
+      reverse: If True, iterate from the last key to the first one. Defaults
+               to False.
+      keys_only: If True, the keys are yielded instead of documents and the
+                 values are not read. Defaults to False.
+      include_value: If False, the values are not read and the documents
+                     yielded are lazy (see `lazy`), which is handy if most of
+                     them will be skipped. Defaults to True.
+      fields: If not None, only load these properties. See `reload`.
+    Returns:
+      A generator of documents, or keys if keys_only is True.
+    """
+    if prefix is not None:
+      start = prefix if start is None else max(start, prefix)
+      prefix_end = _prefix_end(prefix)
+      if prefix_end is not None:
+        end = prefix_end if end is None else min(end, prefix_end)
 
+    if limit is not None and limit <= 0:
+      return
+
+    read_values = include_value and not keys_only
+    count = 0
+    reader = cls._get_reader()
+    for item in reader.RangeIter(start, end, include_value=read_values, reverse=reverse):
+      key = item[0] if read_values else item
+      if prefix is not None and not key.startswith(prefix):
+        # Going backwards, the first key can be the one right after the prefix.
+        if reverse and key > prefix:
+          continue
+        break
+
+      if keys_only:
+        yield key
+      elif read_values:
+        yield cls(key).deserialize(json.loads(item[1]), fields)
       else:
-        for index_value, keys in cls._get_indexdb().RangeIter(_INDEX_KEY.format(f=field, v=start_value), _INDEX_KEY.format(f=field, v=end_value)):
-          keys = json.loads(keys)
-          for key in keys:
-            yield cls(key).reload()
+        yield cls.lazy(key)
+
+      count += 1
+      if limit is not None and count >= limit:
+        break
+
+  def _validate_attribute(self, name):
+    self._ensure_loaded()
+    return EmDocument._validate_attribute(self, name)
 
   def clear(self, to_default=True):
     EmDocument.clear(self, to_default)
+    self._clean = None
+    self._dirty = set()
     self._indexes = set()
     self._removed_indexes = set()
     return self
 
-  def reload(self, verify_checksums=False, fill_cache=True, db=None):
+  def reload(self, verify_checksums=False, fill_cache=True, db=None, fields=None):
     """Reloads the document from the database
 
     Args:
@@ -566,53 +1186,28 @@ class Document(EmDocument):
       fill_cache: See pyleveldb's documentation
       db: A `leveldb.LevelDB` instance to reload from. Defaults to the
           object/class db.
+      fields: If not None, a list of property names to load. The other
+              properties are not converted from the database (which is where
+              the time goes for properties such as EmDocumentsListProperty)
+              and accessing them raises AttributeError. The document becomes
+              read only until it is fully reloaded. Defaults to None.
     """
-    db = self.__class__._get_db(db or self.db)
-    try:
-      value = db.Get(self.key)
-    except KeyError:
-      raise NotFoundError("{0} not found".format(self.key))
-
-    value = json.loads(value)
-
-    self.deserialize(value)
+    value = self.__class__._load_data(self.key, verify_checksums, fill_cache, db or self.db)
+    self.deserialize(value, fields)
     return self
 
 
-  def _add_to_index_write_batch(self, field, value):
+  def _add_to_index_write_batch(self, batch, field, value):
     if value is None: # We value is null. This is a refactoring step.
       return
 
-    index_key = _INDEX_KEY.format(f=field, v=value)
-    try:
-      keys = json.loads(self.__class__._get_indexdb().Get(index_key))
-    except KeyError:
-      keys = []
-
-    if self.key not in keys:
-      keys.append(self.key)
-      self.__class__._indexdb_write_batch.Put(index_key, json.dumps(keys))
-      self.__class__._index_write_needed = True
+    batch.add_to_index(_INDEX_KEY.format(f=field, v=value), self.key)
 
-  def _remove_from_index_write_batch(self, field, value):
-    index_key = _INDEX_KEY.format(f=field, v=value)
-    try:
-      keys = json.loads(self.__class__._get_indexdb().Get(index_key))
-    except KeyError:
-      return # Consider as already removed...
-
-    try:
-      keys.remove(self.key)
-    except ValueError:
-      return # Consider as already removed...
-
-    if len(keys) == 0:
-      # do some housekeeping.
-      self.__class__._indexdb_write_batch.Delete(index_key)
-    else:
-      self.__class__._indexdb_write_batch.Put(index_key, json.dumps(keys))
+  def _remove_from_index_write_batch(self, batch, field, value):
+    if value is None: # Never indexed.
+      return
 
-    self.__class__._index_write_needed = True
+    batch.remove_from_index(_INDEX_KEY.format(f=field, v=value), self.key)
 
   def _build_indexes(self, data):
     indexes = {}
@@ -620,7 +1215,7 @@ class Document(EmDocument):
       indexes[name] = copy(data.get(name, None))
     return indexes
 
-  def _figure_out_index_writes(self, old, new):
+  def _figure_out_index_writes(self, old, new, batch):
     # Let the magic begin.
     # > also, this kinda behaviour will usually result in a conflict because
     #   we are caching some states and if it gets modified else where....
@@ -640,19 +1235,19 @@ class Document(EmDocument):
         new_values = set(_temp) if _temp else set()
 
         for v in (old_values - new_values):
-          self._remove_from_index_write_batch(field, v)
+          self._remove_from_index_write_batch(batch, field, v)
         for v in (new_values - old_values):
-          self._add_to_index_write_batch(field, v)
+          self._add_to_index_write_batch(batch, field, v)
       else:
         # other types don't really matter.
         if field not in new:
-          self._remove_from_index_write_batch(field, value)
+          self._remove_from_index_write_batch(batch, field, value)
         else:
           if value != new[field]:
-            self._remove_from_index_write_batch(field, value)
+            self._remove_from_index_write_batch(batch, field, value)
             # None values should be handled by _add_to_index_write_batch and
             # it should simply return.
-            self._add_to_index_write_batch(field, new[field])
+            self._add_to_index_write_batch(batch, field, new[field])
 
     # Now we need to take a look at the new dictionary and make sure to add
     # anything that we missed. We already noted the change in field as well as
@@ -665,9 +1260,9 @@ class Document(EmDocument):
         # TODO: refactor
         if isinstance(value, (list, tuple)):
           for v in value:
-            self._add_to_index_write_batch(field, v)
+            self._add_to_index_write_batch(batch, field, v)
         else:
-          self._add_to_index_write_batch(field, value)
+          self._add_to_index_write_batch(batch, field, value)
 
   def save(self, sync=True, db=None, batch=False):
     """Saves the document to the database
@@ -677,28 +1272,161 @@ class Document(EmDocument):
       db: The db to save to. defaults to object/class db
       batch: If this is a batch operation. If True, it will be queued and
              actually stored when Document.flush (replace Document with your
-             class name) is called. If True, sync and db will be ignored.
+             class name) is called from the same thread. A `Batch` instance
+             is also accepted, in which case it will be stored when that
+             batch is flushed. If not False, sync and db will be ignored.
     Returns:
       self
     """
-    value = self.serialize()
+    write_batch = self.__class__._batch_for(batch)
+    if write_batch is not batch and not batch:
+      if self._queue_save(write_batch, db or self.db):
+        self.__class__._commit(write_batch, sync, db or self.db)
+    else:
+      self._queue_save(write_batch, write_batch.db)
+    return self
 
-    new_indexes = self._build_indexes(value)
-    self._figure_out_index_writes(self._old_indexes, new_indexes)
-    # BUG: (?) Is it possible to fail something so badly that the _old_indexes
-    # never gets flushed? Hopefully not.
-    self._old_indexes = new_indexes
+  @classmethod
+  def save_many(cls, docs, sync=False, chunk=10000, db=None):
+    """Saves many documents, chunk documents per write.
 
-    value = json.dumps(value)
+    This skips most of the per document overhead of calling `save` in a
+    loop: the documents of a chunk are serialized in one go, their index
+    changes are merged so every index entry touched by the chunk is read and
+    rewritten once, and the documents and the indexes of the chunk are each
+    written with a single write.
 
-    if batch:
-      self._write_batch.Put(self.key, value)
-    else:
-      db = self.__class__._get_db(db or self.db)
-      db.Put(self.key, value, sync)
-      self._flush_indexes(sync)
+    Args:
+      docs: An iterable of documents of this class. It is consumed one chunk
+            at a time so it can be a generator.
+      sync: sync argument to pass to leveldb. Defaults to False.
+      chunk: The number of documents per write. Defaults to 10000.
+      db: The db to save to. Defaults to the class db.
+    Returns:
+      The number of documents written. Documents that did not change since
+      they were loaded are not written.
+    """
+    count = 0
+    for docs_chunk in _chunks(docs, chunk):
+      batch = Batch(cls)
+      try:
+        for doc in docs_chunk:
+          if doc._queue_save(batch, db):
+            count += 1
+      except:
+        # The documents queued before are not written either.
+        batch.clear()
+        raise
+      cls._commit(batch, sync, db)
+    return count
+
+  def _queue_save(self, write_batch, db=None):
+    """Queues the writes needed to save this document into write_batch.
 
-    return self
+    Args:
+      db: The db the batch will write the document to. Defaults to the class
+          db.
+    Returns:
+      False if the document did not change and nothing was queued.
+    """
+    self._ensure_loaded()
+    self._ensure_writable()
+    with write_batch.writing(self):
+      if self._clean is None:
+        value = self.serialize()
+        old_indexes = self._old_indexes
+        new_indexes = self._build_indexes(value)
+        self._figure_out_index_writes(old_indexes, new_indexes, write_batch)
+      else:
+        value, changed = self._serialize_changes()
+        new_indexes = self._build_indexes(value)
+        if changed:
+          old_indexes = dict((name, v) for name, v in self._old_indexes.iteritems() if name in changed)
+          self._figure_out_index_writes(old_indexes, dict((name, v) for name, v in new_indexes.iteritems() if name in changed), write_batch)
+        else:
+          stored = self.__class__._stored_value(write_batch, self.key, db)
+          if stored is not None:
+            stored = json.loads(stored)
+            stored.pop(VERSION_KEY, None)
+            if stored == self._clean:
+              return False
+          # Deleted or overwritten since it was loaded or saved (or going to
+          # another db): all of it is written again, and the index entries
+          # of what is stored fixed.
+          self._figure_out_index_writes(self._build_indexes(stored or {}), new_indexes, write_batch)
+      self._old_indexes = new_indexes
+
+      stored = value
+      if self.__class__.VERSIONED:
+        write_batch.expect_version(self.key, self._version)
+        self._version = (self._version or 0) + 1
+        stored = dict(value)
+        stored[VERSION_KEY] = self._version
+
+      write_batch.put(self.key, json.dumps(stored))
+      self.__class__._invalidate_cache((self.key, ))
+      self._mark_clean(value)
+    return True
+
+  def _write_state(self):
+    # What a batch restores with _rollback if the writes queued after this
+    # are not made. See Batch.writing.
+    return self._old_indexes, self._version
+
+  def _rollback(self, state):
+    self._old_indexes, self._version = state
+    # What is stored is not known for sure any more, the next save writes
+    # everything.
+    self._clean = None
+
+  def _mark_clean(self, data):
+    # data is what is (about to be) stored, and is not modified afterwards so
+    # it is kept as it is: loading stays cheap for documents that are never
+    # saved. Only the containers in it are copied, as they can be the very
+    # objects in _data and be modified in place.
+    if self.__class__.TRACK_CHANGES:
+      containers = [name for name, value in data.iteritems() if isinstance(value, (list, tuple, dict))]
+      if containers:
+        data = dict(data)
+        for name in containers:
+          data[name] = mediocre_copy(data[name])
+      self._clean = data
+    self._dirty = set()
+
+  def _serialize_changes(self):
+    """Serializes the document reusing the stored values of the properties
+    that have not changed since it was loaded or saved.
+
+    Returns:
+      (the serialized dictionary, a set of the names that changed)
+    """
+    clean = self._clean
+    d = {}
+    changed = set()
+    for name, value in self._data.iteritems():
+      # Lists, dicts and embedded documents can be changed without going
+      # through __setattr__, so they are always compared.
+      if name in clean and name not in self._dirty and \
+         (name in self._props_to_load or not isinstance(value, (list, tuple, dict, EmDocument))):
+        d[name] = clean[name]
+        continue
+
+      if name in self._meta:
+        if not self._meta[name].validate(value):
+          self._validation_error(name, value)
+        value = self._meta[name].to_db(value)
+      elif self.DEFINED_PROPERTIES_ONLY:
+        raise ValidationError("Property {} is not defined and {} has DEFINED_PROPERTIES_ONLY".format(name, self.__class__.__name__))
+
+      d[name] = value
+      if name not in clean or clean[name] != value:
+        changed.add(name)
+
+    for name in clean:
+      if name not in self._data:
+        changed.add(name)
+
+    return d, changed
 
   def delete(self, sync=True, db=None, batch=False):
     """Deletes the object from the database.
@@ -708,19 +1436,28 @@ class Document(EmDocument):
       db: The db to delete from. defaults to object/class db
       batch: If this is a batch operation. If True, it will be queued and
              actually deleted when Document.flush (replace Document with your
-             class name) is called. If True, sync and db will be ignored.
+             class name) is called from the same thread. A `Batch` instance is
+             also accepted. See `save`. If not False, sync and db will be
+             ignored.
     Returns:
       self
     """
-    self._figure_out_index_writes(self._old_indexes, {})
-    self._old_indexes = {}
-
-    if batch:
-      self._write_batch.Delete(self.key)
-    else:
-      db = self.__class__._get_db(db or self.db)
-      db.Delete(self.key, sync)
-      self._flush_indexes(sync)
+    self._ensure_loaded()
+    self._ensure_writable()
+    write_batch = self.__class__._batch_for(batch)
+    with write_batch.writing(self):
+      self._figure_out_index_writes(self._old_indexes, {}, write_batch)
+      self._old_indexes = {}
+
+      write_batch.delete(self.key)
+      self._clean = None
+      if self.__class__.VERSIONED:
+        write_batch.expect_version(self.key, self._version)
+        self._version = None
+    if write_batch is not batch and not batch:
+      self.__class__._commit(write_batch, sync, db or self.db)
+
+    self.__class__._invalidate_cache((self.key, ))
 
     self.clear(False)
     return self
@@ -743,30 +1480,88 @@ class Document(EmDocument):
               and any reference properties of those objects). The order of the
               list is so that level 1 would be the first argument, level 2 the
               second and so forth.
+              References are expanded one level at a time: all the
+              references of a level are fetched together and a document
+              referenced more than once is only fetched and serialized once
+              (each reference still gets its own dictionary).
     """
+    self._ensure_loaded()
+    d = EmDocument.serialize(self, True, restricted)
     if include_key:
-      d = EmDocument.serialize(self, True, restricted)
       d["key"] = self.key
-    else:
-      d = EmDocument.serialize(self, True, restricted)
 
     if len(expand) > 0:
-      kwargs = expand.pop(0)
-      for name, attr in self._meta.iteritems():
-        if isinstance(attr, ReferenceProperty) and name not in restricted and self[name] is not None:
-          # we copy to make sure that there is no weird bug when we pop at
-          # different points of the stack. Shallow copy is good enough as the
-          # dicts themselves are readonly.
-          kwargs["expand"] = copy(expand)
-          d[name] = self[name].serialize(**kwargs)
+      _expand_references([(self, d)], expand)
 
     if not dictionary:
       return json.dumps(d)
     return d
 
-  def deserialize(self, data):
-    self._old_indexes = self._build_indexes(data)
-    return EmDocument.deserialize(self, data)
+  @classmethod
+  def serialize_many(cls, docs, dictionary=True, restricted=tuple(), include_key=False, expand=[]):
+    """Serializes a list of documents. This is the same as calling `serialize`
+    on each of them except that the references are expanded for all the
+    documents together, which means a level of references of the whole list
+    is fetched at once.
+
+    Args:
+      docs: A list of documents.
+      Everything else is the same as `serialize`.
+    Returns:
+      A list of the serialized documents in the same order as docs.
+    """
+    serialized = []
+    for doc in docs:
+      serialized.append((doc, doc.serialize(True, restricted, include_key)))
+
+    if len(expand) > 0:
+      _expand_references(serialized, expand)
+
+    if not dictionary:
+      return [json.dumps(d) for _, d in serialized]
+    return [d for _, d in serialized]
+
+  def deserialize(self, data, fields=None):
+    """Deserializes the data. See `EmDocument.deserialize`.
+
+    Args:
+      data: The data dictionary from the database.
+      fields: If not None, only deserialize these properties and make the
+              document read only. See `reload`.
+
+    Returns:
+      self
+    """
+    self._pending_load = False
+    if self._partial is not None:
+      self._partial = None
+      self.clear()
+
+    if VERSION_KEY in data:
+      data = dict(data)
+      self._version = data.pop(VERSION_KEY)
+    else:
+      self._version = 0
+
+    if fields is None:
+      self._old_indexes = self._build_indexes(data)
+      EmDocument.deserialize(self, data)
+      self._mark_clean(data)
+      return self
+
+    fields = frozenset(fields)
+    self.clear()
+    EmDocument.deserialize(self, dict((name, value) for name, value in data.iteritems() if name in fields))
+    for name in self._data.keys():
+      if name not in fields:
+        del self._data[name]
+
+    self._partial = fields
+    return self
+
+  def _ensure_writable(self):
+    if self._partial is not None:
+      raise DatabaseError("{0} is a partially loaded document and is read only.".format(self.key))
 
   @classmethod
   def delete_key(cls, key, sync=False, db=None, batch=False):
@@ -778,13 +1573,566 @@ class Document(EmDocument):
       db: The db to delete from. defaults to object/class db
       batch: If this is a batch operation. If True, it will be queued and
              actually deleted when Document.flush (replace Document with your
-             class name) is called. If True, sync and db will be ignored.
+             class name) is called from the same thread. A `Batch` instance is
+             also accepted. See `save`. If not False, sync and db will be
+             ignored.
+
+    If the class has indexes, the stored value is read so the document can be
+    removed from them.
+    """
+    cls._wait_for_writes()
+    write_batch = cls._batch_for(batch)
+    cls._queue_delete(write_batch, key, db=db)
+    if write_batch is not batch and not batch:
+      cls._commit(write_batch, sync, db)
+
+    cls._invalidate_cache((key, ))
+
+  @classmethod
+  def _queue_delete(cls, write_batch, key, value=None, db=None):
+    """Queues deleting a document and removing it from the indexes into
+    write_batch.
+
+    Args:
+      value: The stored value of the document if it was already read. It is
+             read from db if needed otherwise.
     """
-    if batch:
-      cls._write_batch.Delete(key)
+    if cls._indexes:
+      if value is None:
+        value = cls._stored_value(write_batch, key, db)
+
+      if value is not None:
+        doc = cls(key)
+        doc._figure_out_index_writes(doc._build_indexes(json.loads(value)), {}, write_batch)
+
+    write_batch.delete(key)
+
+  @classmethod
+  def delete_where(cls, field, start_value, end_value=None, sync=False, chunk=1000):
+    """Deletes the documents matching an index lookup (see `index`), along
+    with their index entries.
+
+    The matching keys are streamed from the index and the documents are
+    deleted chunk documents per write, so this works on any number of
+    matches.
+
+    Args:
+      field: The field name. "$key" and "$bucket" are accepted as well (see
+             `delete_range`).
+      start_value: the value to look for, or the beginning value for a range
+      end_value: if not None, all the documents with a value between
+                 start_value and end_value are deleted.
+      sync: sync argument to pass to leveldb. Defaults to False.
+      chunk: The number of documents per write. Defaults to 1000.
+    Returns:
+      The number of documents deleted. Stale index entries, of documents
+      that do not exist, are removed without being counted.
+
+    Raises:
+      DatabaseError if no index database is defined.
+    """
+    cls._ensure_indexdb_exists(field)
+
+    if field == "$bucket":
+      return cls.delete_range(sync=sync, chunk=chunk)
+    if field == "$key":
+      return cls.delete_range(start_value, end_value, sync, chunk)
+
+    cls._wait_for_writes()
+    count = 0
+    # key => whether the document exists. A document in more than one of the
+    # matched entries is only deleted once.
+    found = {}
+    for items in _chunks(cls._iter_index_items(field, start_value, end_value), chunk):
+      batch = Batch(cls)
+      for index_key, key in items:
+        if key not in found:
+          value = cls._stored_value(batch, key)
+          found[key] = value is not None
+          if found[key]:
+            cls._queue_delete(batch, key, value)
+            count += 1
+        if not found[key]:
+          batch.remove_from_index(index_key, key)
+      cls._commit(batch, sync)
+    cls._maybe_compact(count)
+    return count
+
+  @classmethod
+  def delete_range(cls, start=None, end=None, sync=False, chunk=1000):
+    """Deletes the documents with keys between start and end, along with
+    their index entries, chunk documents per write.
+
+    Args:
+      start: the first key (inclusive). Defaults to the beginning of the db.
+      end: the last key (inclusive). Defaults to the end of the db.
+      sync: sync argument to pass to leveldb. Defaults to False.
+      chunk: The number of documents per write. Defaults to 1000.
+    Returns:
+      The number of documents deleted.
+    """
+    # The values are only needed to find the index entries to update.
+    read_values = bool(cls._indexes)
+    cls._wait_for_writes()
+    db = cls._get_db()
+    items = db.RangeIter(start, end, include_value=read_values)
+
+    count = 0
+    for chunk_items in _chunks(items, chunk):
+      batch = Batch(cls)
+      for item in chunk_items:
+        if read_values:
+          cls._queue_delete(batch, item[0], item[1])
+        else:
+          batch.delete(item)
+      count += len(chunk_items)
+      cls._commit(batch, sync)
+    cls._maybe_compact(count, start, end)
+    return count
+
+  @classmethod
+  def export(cls, fp, start=None, end=None):
+    """Writes the documents between start and end to a file, one JSON object
+    per line ({"key": key, "data": stored data}). The stored values are
+    written as they are, without being decoded.
+
+    Args:
+      fp: A file like object to write to.
+      start: the first key (inclusive). Defaults to the beginning of the db.
+      end: the last key (inclusive). Defaults to the end of the db.
+    Returns:
+      The number of documents written.
+    """
+    count = 0
+    reader = cls._get_reader()
+    for key, value in reader.RangeIter(start, end):
+      fp.write('{"key": ' + json.dumps(key) + ', "data": ' + value + '}\n')
+      count += 1
+    return count
+
+  @classmethod
+  def import_(cls, fp, chunk=10000, sync=False, db=None):
+    """Loads the documents of a file written by `export`, replacing the
+    documents with the same keys. The documents are written chunk documents
+    per write without touching the indexes, which are rebuilt with
+    `rebuild_indexes` at the end.
+
+    Args:
+      fp: An iterable of lines, such as a file.
+      chunk: The number of documents per write. Defaults to 10000.
+      sync: sync argument to pass to leveldb. Defaults to False.
+      db: The db to load into. Defaults to the class db. The indexes are
+          only rebuilt for the class db.
+    Returns:
+      The number of documents loaded.
+    """
+    count = 0
+    lines = (line for line in fp if line.strip())
+    for lines_chunk in _chunks(lines, chunk):
+      batch = Batch(cls)
+      for line in lines_chunk:
+        item = json.loads(line)
+        batch.put(item["key"].encode("utf-8") if isinstance(item["key"], unicode) else item["key"], json.dumps(item["data"]))
+      batch.flush(sync, db)
+      count += len(lines_chunk)
+
+    if db is None and cls._indexes and cls.indexdb:
+      cls.rebuild_indexes(chunk, sync)
+    return count
+
+  @classmethod
+  def rebuild_indexes(cls, chunk=10000, sync=False):
+    """Throws away the index entries of the class and builds them again from
+    the documents in the db. Each index entry is written once per chunk
+    documents instead of once per document.
+
+    Args:
+      chunk: The number of documents read per write. Defaults to 10000.
+      sync: sync argument to pass to leveldb. Defaults to False.
+    Returns:
+      The number of documents indexed.
+
+    Raises:
+      DatabaseError if no index database is defined.
+    """
+    cls._ensure_indexdb_exists("$bucket")
+    with cls._write_lock:
+      indexdb = cls._get_indexdb()
+      for field in cls._indexes:
+        prefix = _INDEX_KEY.format(f=field, v="")
+        keys = (key for key in indexdb.RangeIter(prefix, _prefix_end(prefix), include_value=False) if key.startswith(prefix))
+        for keys_chunk in _chunks(keys, chunk):
+          write_batch = new_write_batch(indexdb)
+          for key in keys_chunk:
+            write_batch.Delete(key)
+          indexdb.Write(write_batch, sync=sync)
+
+      count = 0
+      db = cls._get_db()
+      for items in _chunks(db.RangeIter(), chunk):
+        batch = Batch(cls)
+        for key, value in items:
+          doc = cls(key)
+          doc._figure_out_index_writes({}, doc._build_indexes(json.loads(value)), batch)
+        batch.flush(sync)
+        count += len(items)
+    cls._maybe_compact(count, documents=False)
+    return count
+
+  @classmethod
+  def compact(cls, start=None, end=None, include_indexes=True):
+    """Compacts the class db between start and end, which reclaims the space
+    of deleted and overwritten documents right away instead of waiting for
+    leveldb to get to it. This blocks until it is done and can take a while
+    on large ranges.
+
+    Args:
+      start: the first key. Defaults to the beginning of the db.
+      end: the last key. Defaults to the end of the db.
+      include_indexes: If True, the whole indexdb is compacted as well, as
+                       the index entries of the documents are not in a range.
+                       Defaults to True.
+    """
+    cls._compact_range(cls._get_db(), start, end)
+    if include_indexes and cls.indexdb:
+      cls._compact_range(cls._get_indexdb())
+
+  @staticmethod
+  def _compact_range(db, start=None, end=None):
+    kwargs = {}
+    if start is not None:
+      kwargs["start"] = start
+    if end is not None:
+      kwargs["end"] = end
+    db.CompactRange(**kwargs)
+
+  @classmethod
+  def _maybe_compact(cls, count, start=None, end=None, documents=True):
+    if cls.AUTO_COMPACT_AFTER is None or count < cls.AUTO_COMPACT_AFTER:
+      return
+
+    if documents:
+      cls.compact(start, end)
     else:
-      db = cls._get_db(db)
-      db.Delete(cls.key, sync)
+      cls._compact_range(cls._get_indexdb())
+
+  @classmethod
+  def approximate_sizes(cls, ranges):
+    """Measures how much data is stored in key ranges, such as to find the
+    ranges worth compacting.
+
+    The leveldb binding has no GetApproximateSizes, so the ranges are read
+    and this is the size of the keys and values before compression.
+
+    Args:
+      ranges: A list of (start, end) tuples, inclusive. None means the
+              beginning or the end of the db.
+    Returns:
+      A list of (number of documents, bytes) tuples, one per range.
+    """
+    reader = cls._get_reader()
+    sizes = []
+    for start, end in ranges:
+      count = size = 0
+      for key, value in reader.RangeIter(start, end):
+        count += 1
+        size += len(key) + len(value)
+      sizes.append((count, size))
+    return sizes
+
+  @classmethod
+  def _stored_value(cls, write_batch, key, db=None):
+    # The value of key once write_batch is written: the value queued in the
+    # batch if it writes key, the stored value otherwise. None if there is
+    # none.
+    if key in write_batch:
+      return write_batch.get(key)
+    try:
+      return cls._get_db(db).Get(key)
+    except KeyError:
+      return None
+
+  @classmethod
+  def update(cls, key, set=None, inc=None, push=None, pull=None, sync=True, db=None, batch=False):
+    """Changes some fields of a stored document without loading it as a
+    document. The stored value is read once, changed and written back, and
+    only the index entries of the changed fields are updated:
+
+      Page.update("home", inc={"views": 1}, push={"visitors": "bob"})
+
+    The read and the write happen while holding the write lock of the class,
+    so concurrent updates in this process do not lose each other's changes.
+    With a `write_behind` queue, the writes queued before are written first
+    and the update is written right away rather than queued.
+
+    Args:
+      key: the key of the document.
+      set: A dictionary of field => value to store.
+      inc: A dictionary of field => amount to add to the number in the field.
+           A missing field counts as 0.
+      push: A dictionary of field => item to append to the list in the field.
+            A missing field counts as an empty list.
+      pull: A dictionary of field => item to remove (every occurrence of) from
+            the list in the field.
+      The new values of the fields are validated and converted like `save`
+      does.
+      sync: sync argument to pass to leveldb
+      db: The db to update in. Defaults to the class db.
+      batch: See `save`. The document is read right away but only written
+             when the batch is flushed, so writes to the same document in
+             between are lost.
+    Returns:
+      The new stored data of the document, as a dictionary.
+
+    Raises:
+      NotFoundError if the key does not exist.
+      ValidationError if a new value does not pass validation, if inc is used
+      on a field that is not a number or push or pull on a field that is not
+      a list.
+    """
+    cls._wait_for_writes()
+    write_batch = cls._batch_for(batch)
+    # The batch is locked first, as its flush does, in case another thread
+    # flushes it in the meantime.
+    with write_batch._lock, cls._write_lock:
+      value = cls._stored_value(write_batch, key, db)
+      if value is None:
+        raise NotFoundError("{0} not found".format(key))
+
+      data = cls._queue_update(write_batch, key, value, set, inc, push, pull)
+      if write_batch is not batch and not batch:
+        # Not through the group commit, which would write it after the lock
+        # is released.
+        write_batch.flush(sync, db)
+    return data
+
+  @classmethod
+  def update_many(cls, keys, set=None, inc=None, push=None, pull=None, sync=False, chunk=1000):
+    """Applies the same `update` to many documents, chunk documents per write.
+    Keys that do not exist are skipped.
+
+    Args:
+      keys: An iterable of keys. It is consumed one chunk at a time.
+      set, inc, push, pull: See `update`.
+      sync: sync argument to pass to leveldb. Defaults to False.
+      chunk: The number of documents per write. Defaults to 1000.
+    Returns:
+      The number of documents updated.
+
+    Raises:
+      ValidationError as `update` does.
+    """
+    cls._wait_for_writes()
+    count = 0
+    for keys_chunk in _chunks(keys, chunk):
+      batch = Batch(cls)
+      with batch._lock, cls._write_lock:
+        for key in keys_chunk:
+          value = cls._stored_value(batch, key)
+          if value is not None:
+            cls._queue_update(batch, key, value, set, inc, push, pull)
+            count += 1
+        batch.flush(sync)
+    return count
+
+  @classmethod
+  def mutate(cls, key, fn, retries=5, backoff=0.01, sync=True):
+    """Gets a document, calls fn on it and saves it. If the save raises
+    ConflictError, which can only happen for VERSIONED classes, the document
+    is read again and fn called again after waiting a bit, so fn should only
+    change the document:
+
+      def add_tag(doc):
+        doc.tags.append("leveldb")
+      Post.mutate(key, add_tag)
+
+    Args:
+      key: the key of the document.
+      fn: A function taking the document.
+      retries: How many times to start over. Defaults to 5.
+      backoff: The wait in seconds before the first retry. It doubles with
+               every retry, with some randomness so writers that conflicted
+               do not conflict again. Defaults to 0.01.
+      sync: sync argument to pass to leveldb
+    Returns:
+      The saved document.
+
+    Raises:
+      NotFoundError if the key does not exist.
+      ConflictError if the document still conflicts after the last retry.
+    """
+    attempt = 0
+    while True:
+      cls._wait_for_writes()
+      doc = cls.get(key)
+      fn(doc)
+      batch = Batch(cls)
+      try:
+        if doc._queue_save(batch, doc.db):
+          # Not through the write behind queue, which would only report the
+          # conflict once this returned.
+          cls._commit(batch, sync, doc.db, queue=False)
+        return doc
+      except ConflictError:
+        if attempt >= retries:
+          raise
+        sleep(backoff * (2 ** attempt) * uniform(0.5, 1.5))
+        attempt += 1
+
+  @classmethod
+  def _update_to_db(cls, name, value):
+    # Validates and converts the new value of a field like save does.
+    if name in cls._meta:
+      if not cls._meta[name].validate(value):
+        raise ValidationError("'{0}' doesn't pass validation for property '{1}'".format(value, name))
+      return cls._meta[name].to_db(value)
+    elif cls.DEFINED_PROPERTIES_ONLY:
+      raise ValidationError("Property {} is not defined and {} has DEFINED_PROPERTIES_ONLY".format(name, cls.__name__))
+    return value
+
+  @classmethod
+  def _update_from_db(cls, name, value):
+    if name in cls._meta and value is not None:
+      return cls._meta[name].from_db(value)
+    return value
+
+  @classmethod
+  def _update_list(cls, name, data):
+    # The list in a field to push to or pull from, as a new list.
+    items = cls._update_from_db(name, data.get(name))
+    if items is None:
+      return []
+    if not isinstance(items, (list, tuple)):
+      raise ValidationError("Property '{0}' is not a list".format(name))
+    return list(items)
+
+  @classmethod
+  def _queue_update(cls, write_batch, key, value, set_, inc, push, pull):
+    """Applies the changes of `update` to value, the stored value of key, and
+    queues the writes into write_batch.
+
+    Returns:
+      The new data.
+    """
+    data = json.loads(value)
+    old = {}
+    new = {}
+
+    def change(name, v):
+      v = cls._update_to_db(name, v)
+      if name in cls._indexes:
+        old.setdefault(name, copy(data.get(name)))
+      data[name] = v
+
+    for name, v in (set_ or {}).iteritems():
+      change(name, v)
+
+    for name, amount in (inc or {}).iteritems():
+      try:
+        v = (cls._update_from_db(name, data.get(name)) or 0) + amount
+      except TypeError:
+        raise ValidationError("Cannot add {0!r} to property '{1}'".format(amount, name))
+      change(name, v)
+
+    for name, item in (push or {}).iteritems():
+      change(name, cls._update_list(name, data) + [item])
+
+    for name, item in (pull or {}).iteritems():
+      items = cls._update_list(name, data)
+      prop = cls._meta.get(name)
+      if prop is not None:
+        # Compared as stored, as embedded documents are not comparable.
+        pulled = prop.to_db([item])
+        items = [v for v in items if prop.to_db([v]) != pulled]
+      else:
+        items = [v for v in items if v != item]
+      change(name, items)
+
+    if old:
+      for name in old.keys():
+        if data.get(name) is not None:
+          new[name] = data[name]
+        if old[name] is None:
+          del old[name]
+      doc = cls(key)
+      doc._figure_out_index_writes(old, new, write_batch)
+
+    if cls.VERSIONED:
+      version = data.get(VERSION_KEY, 0)
+      write_batch.expect_version(key, version)
+      data[VERSION_KEY] = version + 1
+
+    write_batch.put(key, json.dumps(data))
+    cls._invalidate_cache((key, ))
+    return data
+
+  # Asynchronous API. These return asyncio futures (or trollius futures on
+  # python 2) and run the blocking leveldb calls on a thread pool dedicated to
+  # the class. See leveldbkit.aio.
+
+  @classmethod
+  def aget(cls, key, fields=None):
+    """Asynchronous `get`. Gets issued in the same iteration of the event
+    loop are fetched together.
+
+    Returns:
+      A future of the document. It raises NotFoundError if the key does not
+      exist.
+    """
+    return _aio().get(cls, key, fields)
+
+  @classmethod
+  def aget_many(cls, keys, fields=None):
+    """Asynchronous `get_many`. Returns a future of the dictionary."""
+    return _aio().run(cls, cls.get_many, keys, fields=fields)
+
+  @classmethod
+  def aindex(cls, field, start_value, end_value=None, fields=None, chunk_size=100):
+    """Asynchronous `index`. Returns an asynchronous iterator, to be used with
+    `async for`, that fetches chunk_size documents at a time."""
+    return _aio().AsyncDocumentIterator(cls, cls.index(field, start_value, end_value, fields), chunk_size)
+
+  def asave(self, *args, **kwargs):
+    """Asynchronous `save`. Takes the same arguments and returns a future of
+    the document."""
+    return _aio().run(self.__class__, self.save, *args, **kwargs)
+
+  def adelete(self, *args, **kwargs):
+    """Asynchronous `delete`. Takes the same arguments and returns a future of
+    the document."""
+    return _aio().run(self.__class__, self.delete, *args, **kwargs)
+
+  def __getattr__(self, name):
+    if name[0] != "_" and self.__dict__.get("_pending_load"):
+      self._ensure_loaded()
+    return EmDocument.__getattr__(self, name)
+
+  def __setattr__(self, name, value):
+    if name[0] != "_" and name != "key":
+      if self.__dict__.get("_pending_load"):
+        self._ensure_loaded()
+      if self.__dict__.get("_partial") is not None:
+        raise AttributeError("Cannot set '{0}' as {1} is partially loaded and read only.".format(name, self.key))
+      if "_dirty" in self.__dict__:
+        self._dirty.add(name)
+        self._props_to_load.discard(name)
+    elif name == "key":
+      # A new key is a new document as far as the database is concerned.
+      self.__dict__["_clean"] = None
+      self.__dict__["_version"] = None
+    EmDocument.__setattr__(self, name, value)
+
+  def __delattr__(self, name):
+    self._ensure_loaded()
+    if self._partial is not None:
+      raise AttributeError("Cannot delete '{0}' as {1} is partially loaded and read only.".format(name, self.key))
+    EmDocument.__delattr__(self, name)
+    self._dirty.add(name)
+    self._props_to_load.discard(name)
+
+  __setitem__ = __setattr__
+  __getitem__ = __getattr__
+  __delitem__ = __delattr__
 
   def __eq__(self, other):
     """Check equality. However, this only checks if the key are the same and
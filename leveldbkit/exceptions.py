@@ -19,4 +19,5 @@
 class LeveldbkitError(Exception): pass
 class ValidationError(LeveldbkitError): pass
 class NotFoundError(LeveldbkitError): pass
-class DatabaseError(LeveldbkitError): pass
\ No newline at end of file
+class DatabaseError(LeveldbkitError): pass
+class ConflictError(DatabaseError): pass
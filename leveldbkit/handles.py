@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""Keeps the databases opened by path (`Document.OPEN_ONLY_WHEN_NEEDED` and
+`Document.establish_connection`) open between operations.
+
+leveldb only lets one process open a database, and closes it when the last
+reference to the `LevelDB` object goes away. The pool hands out the same
+database for a path to everyone in the process, wrapped in a lease. The
+lease, and the snapshots and iterators made from it, keep the database open.
+The pool drops its own reference once the lease is gone and the database has
+not been used for its idle timeout, which lets other processes open it again.
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import os.path
+import re
+import warnings
+import weakref
+from threading import Condition, Thread, currentThread
+from time import time
+
+from .backends import open_leveldb
+
+_INVALID_OPTION = re.compile(r"'(\w+)' is an invalid keyword argument")
+
+def open_db(path, options=None):
+  """Opens a database with options (a dictionary of keyword arguments to
+  `leveldb.LevelDB`, such as block_cache_size or write_buffer_size). The
+  options the leveldb binding does not know about, such as bloom_filter_bits
+  for py-leveldb, are left out with a warning.
+  """
+  options = dict(options or {})
+  while True:
+    try:
+      return open_leveldb(path, **options)
+    except TypeError, e:
+      match = _INVALID_OPTION.search(str(e))
+      if match is None or match.group(1) not in options:
+        raise
+      warnings.warn("leveldb does not support the option {0}, ignoring it.".format(match.group(1)), RuntimeWarning)
+      del options[match.group(1)]
+
+def _leased(lease, iterator):
+  # A leveldb iterator keeps its database open, so it keeps the lease too.
+  for item in iterator:
+    yield item
+
+class _LeasedSnapshot(object):
+  def __init__(self, lease, snapshot):
+    self._lease = lease
+    self._snapshot = snapshot
+
+  def RangeIter(self, *args, **kwargs):
+    return _leased(self._lease, self._snapshot.RangeIter(*args, **kwargs))
+
+  def __getattr__(self, name):
+    return getattr(self._snapshot, name)
+
+class Lease(object):
+  """A database handed out by the pool, used like the `leveldb.LevelDB`
+  itself. The pool considers the database in use as long as the lease, or a
+  snapshot or an iterator made from it, is referenced."""
+
+  def __init__(self, db):
+    self.db = db
+
+  def RangeIter(self, *args, **kwargs):
+    return _leased(self, self.db.RangeIter(*args, **kwargs))
+
+  def CreateSnapshot(self):
+    return _LeasedSnapshot(self, self.db.CreateSnapshot())
+
+  def __getattr__(self, name):
+    return getattr(self.db, name)
+
+class _Handle(object):
+  def __init__(self, db, idle_timeout):
+    self.db = db
+    self.idle_timeout = idle_timeout
+    self.last_used = time()
+    # A weak reference to the current Lease, None if there is none.
+    self.lease = None
+
+class HandlePool(object):
+  """A set of open databases shared by path."""
+
+  def __init__(self):
+    self._handles = {}
+    self._condition = Condition()
+    self._reaper = None
+
+  def get(self, path, idle_timeout=0, options=None):
+    """Returns the database at path, opening it if it is not open. Everyone
+    getting the same path while the database is in use gets the same
+    `Lease`.
+
+    Args:
+      path: The path to the database.
+      options: The options to open the database with if it is not open. See
+               `open_db`. Defaults to None.
+      idle_timeout: How long, in seconds, the database stays open after its
+                    last use. 0 means it is closed as soon as it is not in
+                    use, which is what OPEN_ONLY_WHEN_NEEDED used to do.
+                    None means it is kept open until `close`. Defaults to 0.
+    Returns:
+      A `Lease` of the `leveldb.LevelDB`.
+    """
+    path = os.path.abspath(path)
+    with self._condition:
+      handle = self._handles.get(path)
+      if handle is None:
+        handle = self._handles[path] = _Handle(open_db(path, options), idle_timeout)
+        if idle_timeout:
+          self._start_reaper()
+      elif idle_timeout is None or (handle.idle_timeout is not None and idle_timeout > handle.idle_timeout):
+        handle.idle_timeout = idle_timeout
+        if idle_timeout:
+          self._start_reaper()
+
+      handle.last_used = time()
+      lease = handle.lease() if handle.lease is not None else None
+      if lease is None:
+        lease = Lease(handle.db)
+        handle.lease = weakref.ref(lease, lambda ref: self._released(path, handle, ref))
+      return lease
+
+  def _released(self, path, handle, ref):
+    # Called when a lease is garbage collected.
+    with self._condition:
+      if handle.lease is not ref:
+        # Replaced by a new lease in the meantime.
+        return
+      handle.lease = None
+      handle.last_used = time()
+      if handle.idle_timeout == 0 and self._handles.get(path) is handle:
+        del self._handles[path]
+        # Closed now rather than when this frame is gone, which could be
+        # after someone else opened the path again.
+        handle.db = None
+      elif handle.idle_timeout and self._reaper is not None:
+        # The reaper does not count handles in use when it picks how long
+        # to wait.
+        self._condition.notify()
+
+  def _start_reaper(self):
+    # Must be called with the condition.
+    if self._reaper is None:
+      self._reaper = Thread(target=self._reap, name="leveldbkit-handle-reaper")
+      self._reaper.daemon = True
+      self._reaper.start()
+    else:
+      self._condition.notify()
+
+  def _idle(self, handle, now):
+    return handle.idle_timeout is not None and handle.lease is None and \
+           now - handle.last_used >= handle.idle_timeout
+
+  def close_idle(self):
+    """Closes the databases that are not in use and have been idle for their
+    timeout.
+
+    Returns:
+      The number of databases closed.
+    """
+    now = time()
+    with self._condition:
+      # Not a list comprehension, which would leave the last handle in a
+      # variable of this frame and keep its db open once the lock is
+      # released.
+      idle = list(path for path, handle in self._handles.iteritems() if self._idle(handle, now))
+      for path in idle:
+        self._handles.pop(path).db = None
+    return len(idle)
+
+  def close(self, path=None):
+    """Stops keeping a database (or all of them if path is None) open. They
+    are closed once their leases are gone.
+    """
+    with self._condition:
+      if path is None:
+        self._handles.clear()
+      else:
+        self._handles.pop(os.path.abspath(path), None)
+
+  def __contains__(self, path):
+    return os.path.abspath(path) in self._handles
+
+  def path_of(self, db):
+    """Returns the path of a database opened by the pool, None if it was not
+    opened by the pool (or is not kept any more)."""
+    with self._condition:
+      for path, handle in self._handles.iteritems():
+        if handle.db is db:
+          return path
+    return None
+
+  def _stop_reaper(self):
+    with self._condition:
+      reaper, self._reaper = self._reaper, None
+      self._condition.notify()
+    if reaper is not None:
+      reaper.join()
+
+  def _reap(self):
+    current = currentThread()
+    while self._reaper is current:
+      self.close_idle()
+      with self._condition:
+        if self._reaper is not current:
+          return
+        # Not a list comprehension, which would leave the last handle in a
+        # variable of this frame and keep its db open.
+        # Only the handles that can become idle count: a timeout of 0 is
+        # handled by _released, and a handle in use is waited for again once
+        # _released notifies.
+        timeouts = list(h.idle_timeout for h in self._handles.itervalues() if h.idle_timeout and h.lease is None)
+        # Checking every half timeout keeps a database open for at most 1.5
+        # times its timeout.
+        self._condition.wait(min(timeouts) / 2.0 if timeouts else None)
+
+pool = HandlePool()
+# The reaper is stopped before the interpreter starts tearing down modules.
+atexit.register(pool._stop_reaper)
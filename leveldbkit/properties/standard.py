@@ -218,12 +218,30 @@ class ReferenceProperty(BaseProperty):
   retrieves on demand. Probably shouldn't even use this as 2i is better in
   most scenarios."""
 
-  def __init__(self, reference_class, strict=False, **kwargs):
+  def __init__(self, reference_class, strict=False, lazy=False, **kwargs):
+    """Initializes a new reference property.
+
+    Args:
+      reference_class: The Document child class that is referenced.
+      strict: If True, a reference to a document that does not exist raises
+              NotFoundError when it is loaded. Otherwise it becomes None.
+              Defaults to False.
+      lazy: If True, the referenced document is not fetched when the
+            referencing document is loaded. Instead, a document that only
+            knows its key is returned and it is fetched when one of its
+            attributes is first accessed. A missing document then raises
+            NotFoundError at that point regardless of `strict`, rather than
+            becoming None. Use `Document.prefetch_related` to fetch the
+            references of many documents at once, which keeps `strict`.
+            Defaults to False.
+      Everything else are inheritted from BaseProperty
+    """
     BaseProperty.__init__(self, **kwargs)
     if not hasattr(reference_class, "get"):
       raise ValueError("ReferenceProperty only accepts Document based classes (offender: {0}).".format(reference_class.__class__))
     self.reference_class = reference_class
     self.strict = strict
+    self.lazy = lazy
 
   def validate(self, value):
     return BaseProperty.validate(self, value) and \
@@ -239,9 +257,12 @@ class ReferenceProperty(BaseProperty):
     if value is None:
       return None
 
+    if self.lazy:
+      return self.reference_class.lazy(value)
+
     try:
-      doc = self.reference_class.get(value)
+      return self.reference_class.get(value)
     except NotFoundError, e:
       if self.strict:
         raise e
-    return doc
+      return None
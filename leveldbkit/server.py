@@ -0,0 +1,497 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""A server process that owns leveldb databases and serves them over a Unix
+socket, so that many processes can use the same databases (leveldb only lets
+one process open a database).
+
+Start the server with the databases it serves, by name:
+
+  python -m leveldbkit.server /tmp/leveldb.sock users=/data/users.db users_index=/data/users_index.db
+
+and use them from several processes:
+
+  client = Client("/tmp/leveldb.sock")
+
+  class User(Document):
+    db = client.database("users")
+    indexdb = client.database("users_index")
+
+The databases of a `Client` look like `leveldb.LevelDB` objects (Get, Put,
+Delete, Write, RangeIter, CreateSnapshot, ...) to leveldbkit. Every request
+is a list of calls answered together, so multi gets (GetMany), write batches
+and range scans (fetched in chunks) cost one round trip. Requests are
+pipelined: the threads sharing a client send their requests without waiting
+for the answers to the others.
+
+The write lock of an indexdb (held while index entries are read and
+rewritten, versions are checked and `update` reads and writes a document)
+also takes a lock of the server when the indexdb is one of its databases
+(see `RemoteLevelDB.lock`), so these writes are serialized across the
+processes as well as across the threads of each process.
+
+Messages are marshalled, so only strings, numbers, None, lists and tuples go
+over the socket.
+"""
+
+from __future__ import absolute_import
+
+import marshal
+import os
+import socket
+import struct
+import sys
+from itertools import count
+from SocketServer import ThreadingUnixStreamServer, BaseRequestHandler
+from threading import Lock, Condition, Thread
+
+from .exceptions import DatabaseError
+from .backends import new_write_batch
+from . import handles
+
+_HEADER = struct.Struct("!I")
+
+def _send(sock, message):
+  data = marshal.dumps(message)
+  sock.sendall(_HEADER.pack(len(data)) + data)
+
+def _recv_exactly(sock, size):
+  chunks = []
+  while size > 0:
+    chunk = sock.recv(min(size, 1 << 20))
+    if not chunk:
+      raise EOFError("Connection closed.")
+    chunks.append(chunk)
+    size -= len(chunk)
+  return "".join(chunks)
+
+def _recv(sock):
+  size, = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+  return marshal.loads(_recv_exactly(sock, size))
+
+def _serving(path):
+  # Whether a server is listening on the socket at path, rather than it being
+  # left over by a server that is gone.
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except socket.error:
+    return False
+  finally:
+    sock.close()
+  return True
+
+class _Handler(BaseRequestHandler):
+  def setup(self):
+    self.snapshots = {}
+    self.snapshot_ids = count()
+    self.closed = False
+    self.send_lock = Lock()
+
+  def finish(self):
+    # A client that goes away does not keep its locks.
+    self.server.release_all(self)
+
+  def handle(self):
+    while True:
+      try:
+        request_id, calls = _recv(self.request)
+      except EOFError:
+        return
+
+      if any(call[0] == "lock" for call in calls):
+        # Waiting for a lock must not hold up the other requests of the
+        # connection, sent by the other threads of the client.
+        thread = Thread(target=self._answer_later, args=(request_id, calls))
+        thread.daemon = True
+        thread.start()
+      else:
+        self._answer(request_id, calls)
+
+  def _answer(self, request_id, calls):
+    results = []
+    for call in calls:
+      try:
+        results.append((True, self._call(*call)))
+      except KeyError, e:
+        results.append((False, "KeyError", str(e)))
+      except Exception, e:
+        results.append((False, e.__class__.__name__, str(e)))
+    with self.send_lock:
+      _send(self.request, (request_id, results))
+
+  def _answer_later(self, request_id, calls):
+    try:
+      self._answer(request_id, calls)
+    except socket.error:
+      # The client went away while waiting.
+      pass
+
+  def _reader(self, name, snapshot):
+    if snapshot is not None:
+      return self.snapshots[snapshot]
+    return self.server.databases[name]
+
+  def _call(self, method, name, args):
+    if name not in self.server.databases:
+      raise ValueError("Unknown database {0}".format(name))
+    db = self.server.databases[name]
+    if method == "get":
+      key, verify_checksums, fill_cache, snapshot = args
+      return self._reader(name, snapshot).Get(key, verify_checksums, fill_cache)
+    elif method == "get_many":
+      keys, snapshot = args
+      reader = self._reader(name, snapshot)
+      values = []
+      for key in keys:
+        try:
+          values.append(reader.Get(key))
+        except KeyError:
+          values.append(None)
+      return values
+    elif method == "put":
+      key, value, sync = args
+      db.Put(key, value, sync=sync)
+    elif method == "delete":
+      key, sync = args
+      db.Delete(key, sync=sync)
+    elif method == "write":
+      ops, sync = args
+      write_batch = new_write_batch(db)
+      for key, value in ops:
+        if value is None:
+          write_batch.Delete(key)
+        else:
+          write_batch.Put(key, value)
+      db.Write(write_batch, sync=sync)
+    elif method == "range":
+      key_from, key_to, include_value, reverse, limit, snapshot = args
+      items = []
+      for item in self._reader(name, snapshot).RangeIter(key_from, key_to, include_value=include_value, reverse=reverse):
+        items.append(item)
+        if len(items) >= limit:
+          break
+      return items
+    elif method == "snapshot":
+      snapshot = next(self.snapshot_ids)
+      self.snapshots[snapshot] = db.CreateSnapshot()
+      return snapshot
+    elif method == "release":
+      for snapshot in args:
+        self.snapshots.pop(snapshot, None)
+    elif method == "compact":
+      start, end = args
+      kwargs = {}
+      if start is not None:
+        kwargs["start"] = start
+      if end is not None:
+        kwargs["end"] = end
+      db.CompactRange(**kwargs)
+    elif method == "stats":
+      return db.GetStats()
+    elif method == "lock":
+      if not self.server.acquire(name, self):
+        raise ValueError("The connection is closed.")
+    elif method == "unlock":
+      self.server.release(name, self)
+    else:
+      raise ValueError("Unknown method {0}".format(method))
+
+class Server(ThreadingUnixStreamServer):
+  """Serves leveldb databases over a Unix socket, one thread per
+  connection."""
+
+  daemon_threads = True
+
+  def __init__(self, path, databases, options=None):
+    """Opens the databases and listens on path.
+
+    Args:
+      path: The path of the Unix socket. A socket left there by a server
+            that is gone is removed.
+      databases: A dictionary of name => path or db (a `leveldb.LevelDB` or
+                 any other `leveldbkit.backends.Backend`).
+      options: The options to open the database paths with. See
+               `leveldbkit.handles.open_db`.
+    Raises:
+      DatabaseError if another server is listening on path.
+    """
+    if os.path.exists(path):
+      if _serving(path):
+        raise DatabaseError("A server is already listening on {0}.".format(path))
+      os.unlink(path)
+
+    self.databases = {}
+    for name, db in databases.iteritems():
+      self.databases[name] = handles.open_db(db, options) if isinstance(db, basestring) else db
+
+    # name => [the connection holding the lock of RemoteLevelDB.lock, how
+    # many times it took it].
+    self._locks = {}
+    self._locks_condition = Condition()
+    ThreadingUnixStreamServer.__init__(self, path, _Handler)
+
+  def acquire(self, name, connection):
+    """Takes the lock of the database name for a connection, waiting until
+    no other connection holds it. A connection can take a lock it holds
+    again, and must then release it as many times.
+
+    Returns:
+      False if the connection was closed while waiting.
+    """
+    with self._locks_condition:
+      while True:
+        if connection.closed:
+          return False
+        holder = self._locks.get(name)
+        if holder is None:
+          holder = self._locks[name] = [connection, 0]
+        if holder[0] is connection:
+          holder[1] += 1
+          return True
+        self._locks_condition.wait()
+
+  def release(self, name, connection):
+    """Releases the lock of the database name taken by a connection."""
+    with self._locks_condition:
+      holder = self._locks.get(name)
+      if holder is None or holder[0] is not connection:
+        raise ValueError("{0} is not locked by this connection".format(name))
+      holder[1] -= 1
+      if holder[1] == 0:
+        del self._locks[name]
+        self._locks_condition.notify_all()
+
+  def release_all(self, connection):
+    """Releases the locks of a connection that is closed."""
+    with self._locks_condition:
+      connection.closed = True
+      for name, holder in self._locks.items():
+        if holder[0] is connection:
+          del self._locks[name]
+      self._locks_condition.notify_all()
+
+class _Connection(object):
+  def __init__(self, path):
+    self.path = path
+    self._sock = None
+    self._ids = count()
+    self._send_lock = Lock()
+    # Guards _reading and _results.
+    self._recv_condition = Condition()
+    self._reading = False
+    self._results = {}
+    self._released = []
+    self._pid = None
+
+  def call(self, calls):
+    """Sends a list of (method, name, args) calls and returns their results."""
+    with self._send_lock:
+      if self._sock is None or self._pid != os.getpid():
+        # A forked process gets a connection of its own.
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self.path)
+        self._pid = os.getpid()
+        self._results = {}
+        self._released = []
+      if self._released:
+        # Piggybacks the release of the snapshots garbage collected since
+        # the last request.
+        released, self._released = self._released, []
+        calls = [("release", calls[0][1], tuple(released))] + list(calls)
+      else:
+        released = None
+      request_id = next(self._ids)
+      _send(self._sock, (request_id, calls))
+
+    # One thread at a time reads the responses and leaves the ones of the
+    # other threads for them. It does not block the others while it waits
+    # for its own, which can take long (see RemoteLevelDB.lock).
+    condition = self._recv_condition
+    while True:
+      with condition:
+        if request_id in self._results:
+          results = self._results.pop(request_id)
+          break
+        if self._reading:
+          condition.wait()
+          continue
+        self._reading = True
+
+      response = None
+      try:
+        response = _recv(self._sock)
+      finally:
+        with condition:
+          self._reading = False
+          if response is not None and response[0] != request_id:
+            self._results[response[0]] = response[1]
+          condition.notify_all()
+      if response[0] == request_id:
+        results = response[1]
+        break
+
+    if released is not None:
+      results = results[1:]
+
+    values = []
+    for result in results:
+      if not result[0]:
+        if result[1] == "KeyError":
+          raise KeyError(result[2])
+        raise DatabaseError("{0}: {1}".format(result[1], result[2]))
+      values.append(result[1])
+    return values
+
+  def release(self, snapshot):
+    self._released.append(snapshot)
+
+class RemoteWriteBatch(object):
+  """A write batch for a `RemoteLevelDB`."""
+
+  def __init__(self):
+    self.ops = []
+
+  def Put(self, key, value):
+    self.ops.append((key, value))
+
+  def Delete(self, key):
+    self.ops.append((key, None))
+
+class _RemoteReader(object):
+  RANGE_CHUNK_SIZE = 1000
+
+  def __init__(self, connection, name, snapshot=None):
+    self._connection = connection
+    self.name = name
+    self._snapshot = snapshot
+
+  def _call(self, method, *args):
+    return self._connection.call([(method, self.name, args)])[0]
+
+  def Get(self, key, verify_checksums=False, fill_cache=True):
+    return self._call("get", key, verify_checksums, fill_cache, self._snapshot)
+
+  def GetMany(self, keys):
+    """Gets many keys in one round trip.
+
+    Returns:
+      A list of the values, with None for the keys that do not exist.
+    """
+    return self._call("get_many", list(keys), self._snapshot)
+
+  def RangeIter(self, key_from=None, key_to=None, include_value=True, reverse=False, verify_checksums=False, fill_cache=True):
+    """Iterates like `leveldb.LevelDB.RangeIter`, fetching RANGE_CHUNK_SIZE
+    items per round trip."""
+    size = self.RANGE_CHUNK_SIZE
+    skip = None
+    while True:
+      items = self._call("range", key_from, key_to, include_value, reverse, size + (skip is not None), self._snapshot)
+      if skip is not None and items and (items[0][0] if include_value else items[0]) == skip:
+        items = items[1:]
+      for item in items:
+        yield item
+      if len(items) < size:
+        return
+
+      last = items[-1][0] if include_value else items[-1]
+      if reverse:
+        # The end is inclusive so the last key comes back first.
+        key_to, skip = last, last
+      else:
+        key_from = last + "\x00"
+
+class _RemoteSnapshot(_RemoteReader):
+  def __del__(self):
+    self._connection.release(self._snapshot)
+
+class RemoteLevelDB(_RemoteReader):
+  """A database of a `Server`, used like a `leveldb.LevelDB`."""
+
+  def Put(self, key, value, sync=False):
+    self._call("put", key, value, sync)
+
+  def Delete(self, key, sync=False):
+    self._call("delete", key, sync)
+
+  def WriteBatch(self):
+    """Returns a write batch to pass to `Write`."""
+    return RemoteWriteBatch()
+
+  def Write(self, write_batch, sync=False):
+    self._call("write", write_batch.ops, sync)
+
+  def CreateSnapshot(self):
+    return _RemoteSnapshot(self._connection, self.name, self._call("snapshot"))
+
+  def CompactRange(self, start=None, end=None):
+    self._call("compact", start, end)
+
+  def GetStats(self):
+    return self._call("stats")
+
+  def lock(self):
+    """Takes the lock of the server for this database, waiting for another
+    connection holding it to release it. The lock belongs to the connection,
+    which is shared by the threads of the process, and can be taken again
+    through it: the threads must agree between them who holds it (the
+    Document classes take it with the write lock of the database, one per
+    database and process). It is held until `unlock` is called as many times
+    or the connection is closed.
+    """
+    self._call("lock")
+
+  def unlock(self):
+    """Releases the lock taken with `lock`."""
+    self._call("unlock")
+
+  def __eq__(self, other):
+    return isinstance(other, RemoteLevelDB) and self._connection is other._connection and self.name == other.name
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash((id(self._connection), self.name))
+
+class Client(object):
+  """A connection to a `Server`, shared by the threads of the process. It
+  connects on the first request."""
+
+  def __init__(self, path):
+    self._connection = _Connection(path)
+
+  def database(self, name):
+    """Returns the database the server serves as name."""
+    return RemoteLevelDB(self._connection, name)
+
+def main(argv):
+  if len(argv) < 3:
+    print >> sys.stderr, "Usage: python -m leveldbkit.server SOCKET NAME=PATH [NAME=PATH ...]"
+    return 1
+
+  databases = dict(arg.split("=", 1) for arg in argv[2:])
+  server = Server(argv[1], databases)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+"""Spreads the documents of a class over several leveldb databases (see
+`Document.shards`), so that they are compacted by different threads and can
+live on different disks.
+
+A document lives in the shard picked by the hash of its key. `ShardedDB`
+looks like a single `leveldb.LevelDB` to the rest of leveldbkit: point
+operations go to the shard of the key and iterations merge the iterators of
+all the shards in key order.
+
+Only the writes to the same shard are atomic: a batch touching several
+shards is written to each of them separately, in parallel.
+
+Each shard has its own lock, so writes to different shards never wait for
+each other.
+"""
+
+from __future__ import absolute_import
+
+import heapq
+import os
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from zlib import crc32
+
+from .backends import new_write_batch
+from . import handles
+
+class _Reversed(object):
+  # Inverts the order of an item so heapq.merge can merge descending
+  # iterators.
+  __slots__ = ("item", )
+
+  def __init__(self, item):
+    self.item = item
+
+  def __lt__(self, other):
+    return other.item < self.item
+
+def _merge(iterators, reverse):
+  # The keys are unique across shards, so (key, value) items are never
+  # compared by value.
+  if not reverse:
+    return heapq.merge(*iterators)
+  return (wrapped.item for wrapped in heapq.merge(*[(_Reversed(item) for item in iterator) for iterator in iterators]))
+
+class _ShardedReader(object):
+  def __init__(self, sharded, readers):
+    self._sharded = sharded
+    self._readers = readers
+
+  def _reader(self, shard):
+    return self._readers[shard]
+
+  def Get(self, key, *args, **kwargs):
+    return self._reader(self._sharded.shard_of(key)).Get(key, *args, **kwargs)
+
+  def RangeIter(self, *args, **kwargs):
+    return _merge([self._reader(i).RangeIter(*args, **kwargs) for i in xrange(len(self._sharded.shards))], kwargs.get("reverse", False))
+
+class ShardedWriteBatch(object):
+  """A `leveldb.WriteBatch` that splits its operations per shard."""
+
+  def __init__(self, sharded):
+    self._sharded = sharded
+    self.batches = {}
+
+  def _batch(self, key):
+    shard = self._sharded.shard_of(key)
+    batch = self.batches.get(shard)
+    if batch is None:
+      # Does not open a shard that is opened only when needed.
+      batch = self.batches[shard] = new_write_batch(self._sharded.shards[shard])
+    return batch
+
+  def Put(self, key, value):
+    self._batch(key).Put(key, value)
+
+  def Delete(self, key):
+    self._batch(key).Delete(key)
+
+class ShardedDB(_ShardedReader):
+  """A set of leveldb databases used as one."""
+
+  def __init__(self, shards, options=None, open_only_when_needed=False, idle_timeout=0):
+    """Opens the shards.
+
+    Args:
+      shards: A list of paths or `leveldb.LevelDB` instances. The order
+              matters: the same key must always go to the same shard.
+      options: The options to open the paths with. See
+               `leveldbkit.handles.open_db`.
+      open_only_when_needed: If True, the paths are only opened (through
+                             `leveldbkit.handles.pool`) while they are used,
+                             like `Document.OPEN_ONLY_WHEN_NEEDED` does.
+                             Defaults to False.
+      idle_timeout: See `Document.HANDLE_IDLE_TIMEOUT`. Only used if
+                    open_only_when_needed is True. Defaults to 0.
+    """
+    if not shards:
+      raise ValueError("ShardedDB needs at least one shard.")
+
+    _ShardedReader.__init__(self, self, None)
+    self.shards = list(shards)
+    self._options = options
+    self._idle_timeout = idle_timeout
+    self._locks = [Lock() for shard in self.shards]
+    self._pool = None
+    self._pool_pid = None
+    self._pool_lock = Lock()
+    if not open_only_when_needed:
+      self.open()
+
+  def open(self):
+    """Opens the shards that are only opened when needed and keeps them open
+    from now on."""
+    self.shards = [handles.pool.get(shard, None, self._options).db if isinstance(shard, basestring) else shard for shard in self.shards]
+
+  def shard(self, i):
+    """Returns shard number i, opening it if needed."""
+    shard = self.shards[i]
+    if isinstance(shard, basestring):
+      return handles.pool.get(shard, self._idle_timeout, self._options)
+    return shard
+
+  _reader = shard
+
+  def shard_of(self, key):
+    """Returns the index of the shard key lives in."""
+    if isinstance(key, unicode):
+      key = key.encode("utf-8")
+    return (crc32(key) & 0xffffffff) % len(self.shards)
+
+  def Get(self, key, *args, **kwargs):
+    # Waits for a write to the shard that is under way.
+    i = self.shard_of(key)
+    with self._locks[i]:
+      return self.shard(i).Get(key, *args, **kwargs)
+
+  def Put(self, key, value, sync=False):
+    i = self.shard_of(key)
+    with self._locks[i]:
+      self.shard(i).Put(key, value, sync=sync)
+
+  def Delete(self, key, sync=False):
+    i = self.shard_of(key)
+    with self._locks[i]:
+      self.shard(i).Delete(key, sync=sync)
+
+  def WriteBatch(self):
+    """Returns a write batch to pass to `Write`."""
+    return ShardedWriteBatch(self)
+
+  def Write(self, write_batch, sync=False):
+    self.begin_write(write_batch, sync)()
+
+  def begin_write(self, write_batch, sync=False):
+    """Locks the shards write_batch writes to and returns a function that
+    writes them, in parallel, and unlocks them. The writes to a shard are
+    made in the order begin_write was called, so a caller that orders its
+    writes with a lock of its own can release it as soon as this returns,
+    before the shards are written.
+    """
+    shards = sorted(write_batch.batches)
+    for i in shards:
+      self._locks[i].acquire()
+
+    def write():
+      try:
+        if len(shards) == 1:
+          self._write_shard((shards[0], write_batch.batches[shards[0]], sync))
+        elif shards:
+          self._thread_pool().map(self._write_shard, [(i, write_batch.batches[i], sync) for i in shards])
+      finally:
+        for i in shards:
+          self._locks[i].release()
+    return write
+
+  def _write_shard(self, args):
+    i, batch, sync = args
+    self.shard(i).Write(batch, sync=sync)
+
+  def _thread_pool(self):
+    with self._pool_lock:
+      # The threads of the pool are not in the processes forked since it was
+      # created.
+      if self._pool is None or self._pool_pid != os.getpid():
+        self._pool = ThreadPool(len(self.shards))
+        self._pool_pid = os.getpid()
+      return self._pool
+
+  def CreateSnapshot(self):
+    # One snapshot per shard, taken while none of them is being written so
+    # the snapshot does not see only a part of a write.
+    for lock in self._locks:
+      lock.acquire()
+    try:
+      return _ShardedReader(self, [self.shard(i).CreateSnapshot() for i in xrange(len(self.shards))])
+    finally:
+      for lock in self._locks:
+        lock.release()
+
+  def CompactRange(self, *args, **kwargs):
+    for i in xrange(len(self.shards)):
+      self.shard(i).CompactRange(*args, **kwargs)
+
+  def GetStats(self):
+    return "\n".join(self.shard(i).GetStats() for i in xrange(len(self.shards)))
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import unittest
+import os.path
+
+from ..properties import *
+from ..document import Document
+from ..exceptions import NotFoundError
+
+import leveldb
+
+try:
+  from .. import aio
+except ImportError:
+  aio = None
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+class AsyncDocument(Document):
+  db = leveldb.LevelDB("{0}/test_aio.db".format(test_dir))
+  indexdb = leveldb.LevelDB("{0}/test_aio_index.db".format(test_dir))
+  ASYNC_MAX_WORKERS = 2
+
+  s = StringProperty(index=True)
+
+@unittest.skipIf(aio is None, "asyncio (or trollius) and concurrent.futures are required")
+class AsyncDocumentTest(unittest.TestCase):
+  def setUp(self):
+    self.loop = aio.asyncio.new_event_loop()
+    aio.asyncio.set_event_loop(self.loop)
+
+  def tearDown(self):
+    for key in AsyncDocument.index_keys_only("$bucket", None):
+      AsyncDocument.get(key).delete()
+    self.loop.close()
+
+  def wait(self, future):
+    return self.loop.run_until_complete(future)
+
+  def test_save_get(self):
+    doc = AsyncDocument("a", data={"s": "meow"})
+    self.assertTrue(self.wait(doc.asave()) is doc)
+
+    a, a2 = self.wait(aio.asyncio.gather(AsyncDocument.aget("a"), AsyncDocument.aget("a"), loop=self.loop))
+    self.assertEquals("meow", a.s)
+    self.assertEquals("meow", a2.s)
+    self.assertFalse(a is a2)
+
+    with self.assertRaises(NotFoundError):
+      self.wait(AsyncDocument.aget("nothere"))
+
+    self.wait(doc.adelete())
+    with self.assertRaises(NotFoundError):
+      AsyncDocument.get("a")
+
+  def test_aindex(self):
+    for i in xrange(5):
+      AsyncDocument(str(i), data={"s": "indexed"}).save()
+
+    iterator = AsyncDocument.aindex("s", "indexed", chunk_size=2)
+    keys = []
+    while True:
+      try:
+        keys.append(self.wait(iterator.__anext__()).key)
+      except aio.StopAsyncIteration:
+        break
+
+    self.assertEquals(["0", "1", "2", "3", "4"], sorted(keys))
+
+  def test_aindex_overlapping_calls(self):
+    for i in xrange(5):
+      AsyncDocument(str(i), data={"s": "overlapping"}).save()
+
+    iterator = AsyncDocument.aindex("s", "overlapping", chunk_size=2)
+    futures = [iterator.__anext__() for i in xrange(7)]
+    futures[1].cancel()
+    self.wait(aio.asyncio.wait(futures, loop=self.loop))
+
+    self.assertTrue(futures[1].cancelled())
+    keys = [f.result().key for f in futures[:1] + futures[2:6]]
+    self.assertEquals(["0", "1", "2", "3", "4"], sorted(keys))
+    self.assertTrue(isinstance(futures[6].exception(), aio.StopAsyncIteration))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import unittest
+
+from ..properties import *
+from ..document import Document
+from ..backends import MemoryDB, new_write_batch
+from ..exceptions import NotFoundError
+
+class MemoryDocument(Document):
+  db = MemoryDB()
+  indexdb = MemoryDB()
+
+  s = StringProperty(index=True)
+  n = NumberProperty()
+
+class MemoryDBTest(unittest.TestCase):
+  def test_range(self):
+    db = MemoryDB()
+    for key in ("b", "d", "a", "c"):
+      db.Put(key, key.upper())
+
+    self.assertEquals([("a", "A"), ("b", "B"), ("c", "C"), ("d", "D")], list(db.RangeIter()))
+    self.assertEquals(["b", "c"], list(db.RangeIter("b", "c", include_value=False)))
+    self.assertEquals(["c", "b"], list(db.RangeIter("aa", "c", include_value=False, reverse=True)))
+    self.assertEquals([], list(db.RangeIter("e")))
+
+    iterator = db.RangeIter(include_value=False)
+    db.Delete("a")
+    db.Delete("missing")
+    self.assertEquals(["a", "b", "c", "d"], list(iterator))
+    self.assertEquals(["b", "c", "d"], list(db.RangeIter(include_value=False)))
+    self.assertRaises(KeyError, db.Get, "a")
+
+  def test_write_batch_and_snapshot(self):
+    db = MemoryDB()
+    db.Put("a", "1")
+    snapshot = db.CreateSnapshot()
+
+    write_batch = new_write_batch(db)
+    write_batch.Put("b", "2")
+    write_batch.Delete("a")
+    write_batch.Put("a", "3")
+    db.Write(write_batch)
+
+    self.assertEquals([("a", "3"), ("b", "2")], list(db.RangeIter()))
+    self.assertEquals([("a", "1")], list(snapshot.RangeIter()))
+    self.assertEquals("1", snapshot.Get("a"))
+    self.assertRaises(KeyError, snapshot.Get, "b")
+
+  def test_versions(self):
+    db = MemoryDB()
+    keys = ["{0:03d}".format(i) for i in xrange(100)]
+    for key in keys:
+      db.Put(key, "old")
+
+    snapshot = db.CreateSnapshot()
+    iterator = db.RangeIter(include_value=False)
+    reverse = db.RangeIter(reverse=True)
+    self.assertEquals("000", next(iterator))
+    # Writes while they are in the middle of the keys.
+    for key in keys[::2]:
+      db.Delete(key)
+    for key in keys[1::2]:
+      db.Put(key, "new")
+    db.Put("050a", "inserted")
+
+    self.assertEquals(keys[1:], list(iterator))
+    self.assertEquals([(key, "old") for key in reversed(keys)], list(reverse))
+    self.assertEquals([(key, "old") for key in keys[10:21]], list(snapshot.RangeIter("010", "020")))
+    self.assertEquals("old", snapshot.Get("000"))
+    self.assertRaises(KeyError, snapshot.Get, "050a")
+    self.assertEquals(keys[1:6:2], list(db.RangeIter("000", "005", include_value=False)))
+
+    # The old values are dropped once nothing needs them.
+    del iterator, reverse, snapshot
+    db.Put("a", "a")
+    self.assertEquals({}, db._history)
+    self.assertEquals(52, len(db._keys))
+
+class MemoryDocumentTest(unittest.TestCase):
+  def tearDown(self):
+    MemoryDocument.delete_range()
+
+  def test_document(self):
+    self.assertTrue(MemoryDocument.db)
+    doc = MemoryDocument("k1", data={"s": "a", "n": 1}).save()
+    MemoryDocument("k2", data={"s": "b", "n": 2}).save()
+
+    self.assertEquals(1, MemoryDocument.get("k1").n)
+    self.assertEquals(["k1"], MemoryDocument.index_keys_only("s", "a"))
+    self.assertEquals(["k2", "k1"], [d.key for d in MemoryDocument.iter_range(reverse=True)])
+
+    doc.s = "c"
+    doc.save()
+    self.assertEquals([], MemoryDocument.index_keys_only("s", "a"))
+    self.assertEquals(["k1"], MemoryDocument.index_keys_only("s", "c"))
+
+    with MemoryDocument.snapshot():
+      doc.delete()
+      self.assertEquals("c", MemoryDocument.get("k1").s)
+
+    self.assertRaises(NotFoundError, MemoryDocument.get, "k1")
+    self.assertEquals([], MemoryDocument.index_keys_only("s", "c"))
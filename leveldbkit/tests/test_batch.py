@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import unittest
+import os.path
+import threading
+import time
+from StringIO import StringIO
+
+from ..properties import *
+from ..document import Document
+from ..batch import Batch, GroupCommitter, _Waiter
+from ..writebehind import WriteBehind
+from ..exceptions import NotFoundError, ConflictError, DatabaseError, ValidationError
+
+import leveldb
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+class BatchDocument(Document):
+  db = leveldb.LevelDB("{0}/test_batch.db".format(test_dir))
+  indexdb = leveldb.LevelDB("{0}/test_batch_index.db".format(test_dir))
+
+  s = StringProperty(index=True)
+
+class SubBatchDocument(BatchDocument):
+  pass
+
+class SlowDB(object):
+  """Makes writes slow enough for concurrent writers to pile up, and counts
+  them."""
+  def __init__(self, db):
+    self.db = db
+    self.writes = 0
+
+  def Write(self, write_batch, sync=False):
+    self.writes += 1
+    time.sleep(0.01)
+    return self.db.Write(write_batch, sync=sync)
+
+  def __getattr__(self, name):
+    return getattr(self.db, name)
+
+class GroupCommitDocument(Document):
+  db = SlowDB(leveldb.LevelDB("{0}/test_group_commit.db".format(test_dir)))
+  indexdb = leveldb.LevelDB("{0}/test_group_commit_index.db".format(test_dir))
+  GROUP_COMMIT = True
+
+  s = StringProperty(index=True)
+
+class VersionedDocument(Document):
+  db = leveldb.LevelDB("{0}/test_versioned.db".format(test_dir))
+  indexdb = leveldb.LevelDB("{0}/test_versioned_index.db".format(test_dir))
+  VERSIONED = True
+
+  s = StringProperty(index=True)
+  n = NumberProperty()
+
+class OnDemandDocument(Document):
+  db = "{0}/test_on_demand.db".format(test_dir)
+  indexdb = "{0}/test_on_demand_index.db".format(test_dir)
+  OPEN_ONLY_WHEN_NEEDED = True
+
+  s = StringProperty(index=True)
+
+class BatchTest(unittest.TestCase):
+  def tearDown(self):
+    BatchDocument.reset_write_batch()
+    for key in BatchDocument.index_keys_only("$bucket", None):
+      BatchDocument.get(key).delete()
+
+  def test_batches_are_per_thread(self):
+    BatchDocument("mine").save(batch=True)
+
+    def other_thread():
+      BatchDocument("theirs").save(batch=True)
+      BatchDocument.reset_write_batch()
+
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    thread.join()
+
+    BatchDocument.flush()
+    BatchDocument.get("mine")
+    with self.assertRaises(NotFoundError):
+      BatchDocument.get("theirs")
+
+  def test_explicit_batch(self):
+    batch = Batch(BatchDocument)
+    BatchDocument("explicit", data={"s": "a"}).save(batch=batch)
+    BatchDocument.flush()
+    with self.assertRaises(NotFoundError):
+      BatchDocument.get("explicit")
+    self.assertEquals(2, len(batch))
+
+    batch.flush()
+    self.assertEquals(0, len(batch))
+    self.assertEquals(["explicit"], BatchDocument.index_keys_only("s", "a"))
+
+  def test_update_into_a_shared_batch(self):
+    BatchDocument("shared", data={"s": "a"}).save()
+    batch = Batch(BatchDocument)
+    done = []
+
+    def update():
+      for i in xrange(200):
+        BatchDocument.update("shared", set={"s": str(i)}, batch=batch)
+      done.append(True)
+
+    def flush():
+      for i in xrange(200):
+        batch.flush()
+      done.append(True)
+
+    threads = [threading.Thread(target=update), threading.Thread(target=flush)]
+    for thread in threads:
+      # Not left behind if they deadlock.
+      thread.daemon = True
+      thread.start()
+    for thread in threads:
+      thread.join(10)
+    self.assertEquals(2, len(done))
+    batch.flush()
+    self.assertEquals("199", BatchDocument.get("shared").s)
+
+  def test_same_index_entry_in_one_batch(self):
+    for i in xrange(3):
+      BatchDocument(str(i), data={"s": "same"}).save(batch=True)
+    BatchDocument.flush()
+    self.assertEquals(["0", "1", "2"], sorted(BatchDocument.index_keys_only("s", "same")))
+
+  def test_context_manager(self):
+    with BatchDocument.batch(max_ops=4, sync=False) as batch:
+      BatchDocument("a", data={"s": "ctx"}).save(batch=True)
+      self.assertEquals(2, len(batch))
+      with self.assertRaises(NotFoundError):
+        BatchDocument.get("a")
+
+      # Reaching max_ops flushes.
+      BatchDocument("b", data={"s": "ctx"}).save(batch=True)
+      self.assertEquals(0, len(batch))
+      BatchDocument.get("a")
+
+      BatchDocument("c").save(batch=True)
+
+    BatchDocument.get("c")
+    self.assertEquals(["a", "b"], sorted(BatchDocument.index_keys_only("s", "ctx")))
+
+    with self.assertRaises(ValueError):
+      with BatchDocument.batch():
+        BatchDocument("d").save(batch=True)
+        raise ValueError
+
+    with self.assertRaises(NotFoundError):
+      BatchDocument.get("d")
+
+    # The batch of the thread is back to normal.
+    BatchDocument("e").save(batch=True)
+    BatchDocument.flush()
+    BatchDocument.get("e")
+
+  def test_max_bytes(self):
+    with BatchDocument.batch(max_bytes=100) as batch:
+      BatchDocument("big", data={"s": "x" * 100}).save(batch=True)
+      self.assertEquals(0, len(batch))
+      BatchDocument.get("big")
+
+  def test_save_many(self):
+    docs = [BatchDocument(str(i), data={"s": "many"}) for i in xrange(25)]
+    self.assertEquals(25, BatchDocument.save_many(iter(docs), chunk=10))
+    self.assertEquals(25, len(BatchDocument.index_keys_only("s", "many")))
+
+    docs[0].s = "changed"
+    self.assertEquals(1, BatchDocument.save_many(docs, chunk=10))
+    self.assertEquals(24, len(BatchDocument.index_keys_only("s", "many")))
+    self.assertEquals(["0"], BatchDocument.index_keys_only("s", "changed"))
+
+  def test_delete_key_updates_indexes(self):
+    BatchDocument("gone", data={"s": "deleted"}).save()
+    BatchDocument("kept", data={"s": "deleted"}).save()
+    BatchDocument.delete_key("gone")
+    self.assertRaises(NotFoundError, BatchDocument.get, "gone")
+    self.assertEquals(["kept"], BatchDocument.index_keys_only("s", "deleted"))
+
+    BatchDocument("queued", data={"s": "queued"}).save(batch=True)
+    BatchDocument.delete_key("queued", batch=True)
+    BatchDocument.flush()
+    self.assertEquals([], BatchDocument.index_keys_only("s", "queued"))
+
+  def test_delete_where(self):
+    for i in xrange(25):
+      BatchDocument("w" + str(i), data={"s": "a" if i % 2 else "b"}).save(batch=True)
+    BatchDocument.flush()
+    # Left in the index.
+    BatchDocument.db.Delete("w1")
+
+    self.assertEquals(11, BatchDocument.delete_where("s", "a", chunk=5))
+    # Including the stale entry.
+    self.assertEquals([], BatchDocument.index_keys_only("s", "a"))
+    self.assertEquals(13, len(BatchDocument.index_keys_only("$bucket", None)))
+
+    self.assertEquals(13, BatchDocument.delete_where("s", "a", "c", chunk=5))
+    self.assertEquals([], BatchDocument.index_keys_only("s", "b"))
+    self.assertEquals([], BatchDocument.index_keys_only("$bucket", None))
+
+  def test_delete_range(self):
+    for i in xrange(10):
+      BatchDocument("r" + str(i), data={"s": "range"}).save(batch=True)
+    BatchDocument.flush()
+
+    self.assertEquals(4, BatchDocument.delete_range("r3", "r6", chunk=3))
+    self.assertEquals(["r0", "r1", "r2", "r7", "r8", "r9"], sorted(BatchDocument.index_keys_only("s", "range")))
+    self.assertEquals(6, len(BatchDocument.index_keys_only("$bucket", None)))
+
+  def test_deletes_open_only_when_needed(self):
+    for i in xrange(10):
+      OnDemandDocument(str(i), data={"s": "a" if i % 2 else "b"}).save()
+
+    self.assertEquals(5, OnDemandDocument.delete_where("s", "a", chunk=2))
+    self.assertEquals(5, OnDemandDocument.delete_range(chunk=2))
+    self.assertEquals([], OnDemandDocument.index_keys_only("s", "b"))
+
+    # Closed once done.
+    db = leveldb.LevelDB(OnDemandDocument.db)
+    del db
+
+  def test_export_import(self):
+    for i in xrange(15):
+      BatchDocument("e" + str(i), data={"s": "exported" if i % 3 else "other"}).save(batch=True)
+    BatchDocument.flush()
+
+    fp = StringIO()
+    self.assertEquals(15, BatchDocument.export(fp))
+    BatchDocument.delete_range()
+    self.assertEquals([], BatchDocument.index_keys_only("s", "exported"))
+
+    fp.seek(0)
+    self.assertEquals(15, BatchDocument.import_(fp, chunk=4))
+    self.assertEquals(10, len(BatchDocument.index_keys_only("s", "exported")))
+    self.assertEquals(5, len(BatchDocument.index_keys_only("s", "other")))
+    self.assertEquals("other", BatchDocument.get("e0").s)
+
+    # Stale entries are thrown away.
+    BatchDocument.delete_key("e1")
+    BatchDocument.indexdb.Put("s~exported", '["nope"]')
+    self.assertEquals(14, BatchDocument.rebuild_indexes(chunk=4))
+    self.assertEquals(9, len(BatchDocument.index_keys_only("s", "exported")))
+
+  def test_compact(self):
+    for i in xrange(10):
+      BatchDocument("c" + str(i), data={"s": "compacted"}).save(batch=True)
+    BatchDocument.flush()
+
+    sizes = BatchDocument.approximate_sizes([(None, None), ("c2", "c4"), ("d", None)])
+    self.assertEquals([10, 3, 0], [count for count, size in sizes])
+    self.assertEquals(len("c2") + len(BatchDocument.db.Get("c2")), sizes[1][1] / 3)
+
+    BatchDocument.compact()
+    BatchDocument.compact("c0", "c5", include_indexes=False)
+
+    calls = []
+    BatchDocument.compact = classmethod(lambda cls, start=None, end=None: calls.append((start, end)))
+    BatchDocument.AUTO_COMPACT_AFTER = 3
+    try:
+      BatchDocument.delete_range("c0", "c1")
+      self.assertEquals([], calls)
+      BatchDocument.delete_range("c2", "c5")
+      self.assertEquals([("c2", "c5")], calls)
+    finally:
+      del BatchDocument.compact
+      del BatchDocument.AUTO_COMPACT_AFTER
+
+  def test_concurrent_index_writes(self):
+    def save_many(cls, prefix):
+      for i in xrange(20):
+        cls(prefix + str(i), data={"s": "shared"}).save(batch=True)
+        if i % 5 == 0:
+          cls.flush()
+      cls.flush()
+
+    # A subclass shares the indexdb, and so the lock, of its parent.
+    self.assertTrue(SubBatchDocument._write_lock is BatchDocument._write_lock)
+    threads = [threading.Thread(target=save_many, args=(BatchDocument if i % 2 else SubBatchDocument, p)) for i, p in enumerate("abcd")]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEquals(80, len(BatchDocument.index_keys_only("s", "shared")))
+
+class GroupCommitTest(unittest.TestCase):
+  def test_concurrent_saves_are_grouped(self):
+    def save_many(prefix):
+      for i in xrange(5):
+        GroupCommitDocument(prefix + str(i), data={"s": "grouped"}).save()
+
+    threads = [threading.Thread(target=save_many, args=(p, )) for p in "abcdefgh"]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEquals(40, len(GroupCommitDocument.index_keys_only("$bucket", None)))
+    self.assertEquals(40, len(GroupCommitDocument.index_keys_only("s", "grouped")))
+    self.assertTrue(GroupCommitDocument.db.writes < 40)
+
+    for key in GroupCommitDocument.index_keys_only("$bucket", None):
+      GroupCommitDocument.get(key).delete()
+    self.assertEquals([], GroupCommitDocument.index_keys_only("s", "grouped"))
+
+class VersionTest(unittest.TestCase):
+  def tearDown(self):
+    VersionedDocument.delete_range()
+
+  def test_conflicting_saves(self):
+    VersionedDocument("doc", data={"s": "a"}).save()
+    first = VersionedDocument.get("doc")
+    second = VersionedDocument.get("doc")
+
+    first.s = "b"
+    first.save()
+    second.s = "c"
+    self.assertRaises(ConflictError, second.save)
+    self.assertEquals("b", VersionedDocument.get("doc").s)
+    self.assertEquals(["doc"], VersionedDocument.index_keys_only("s", "b"))
+    self.assertEquals([], VersionedDocument.index_keys_only("s", "c"))
+    # The version is not bumped by a save that conflicted.
+    self.assertRaises(ConflictError, second.save)
+
+    # Saving the same document again is fine, and so is update.
+    first.s = "d"
+    first.save()
+    VersionedDocument.update("doc", set={"s": "e"})
+    self.assertRaises(ConflictError, first.delete)
+
+    self.assertRaises(ConflictError, VersionedDocument("doc", data={"s": "new"}).save)
+    self.assertFalse("_version" in VersionedDocument.get("doc").serialize())
+
+  def test_failing_save_many(self):
+    doc = VersionedDocument("a", data={"s": "x"})
+    invalid = VersionedDocument("b", data={"n": "not a number"})
+    self.assertRaises(ValidationError, VersionedDocument.save_many, [doc, invalid])
+    self.assertRaises(NotFoundError, VersionedDocument.get, "a")
+
+    # doc is saved as if save_many had not been called.
+    doc.save()
+    self.assertEquals(["a"], VersionedDocument.index_keys_only("s", "x"))
+
+  def test_conflicts_in_a_group(self):
+    VersionedDocument("doc", data={"s": "a"}).save()
+    batches = []
+    for value in "bc":
+      doc = VersionedDocument.get("doc")
+      doc.s = value
+      batch = Batch(VersionedDocument)
+      doc.save(batch=batch)
+      batches.append(batch)
+
+    waiters = [_Waiter(batch, None) for batch in batches]
+    GroupCommitter(VersionedDocument)._write(waiters)
+    self.assertEquals(None, waiters[0].error)
+    self.assertTrue(isinstance(waiters[1].error, ConflictError))
+    self.assertEquals("b", VersionedDocument.get("doc").s)
+
+  def test_mutate(self):
+    VersionedDocument("doc", data={"s": "a"}).save()
+    calls = []
+
+    def append(doc):
+      calls.append(doc.s)
+      if len(calls) == 1:
+        other = VersionedDocument.get("doc")
+        other.s = "other"
+        other.save()
+      doc.s += "!"
+
+    VersionedDocument.mutate("doc", append, backoff=0)
+    self.assertEquals(["a", "other"], calls)
+    self.assertEquals("other!", VersionedDocument.get("doc").s)
+
+class WriteBehindDocument(Document):
+  db = leveldb.LevelDB("{0}/test_write_behind.db".format(test_dir))
+  indexdb = leveldb.LevelDB("{0}/test_write_behind_index.db".format(test_dir))
+  write_behind = WriteBehind(max_queue=10)
+
+  s = StringProperty(index=True)
+  n = NumberProperty()
+
+class WriteBehindTest(unittest.TestCase):
+  def tearDown(self):
+    WriteBehindDocument.delete_range()
+    WriteBehindDocument.write_behind.drain()
+
+  def test_write_behind(self):
+    docs = [WriteBehindDocument(str(i), data={"s": "behind"}) for i in xrange(50)]
+    for doc in docs:
+      doc.save()
+    docs[0].delete()
+    WriteBehindDocument.write_behind.drain()
+
+    self.assertEquals(0, len(WriteBehindDocument.write_behind))
+    self.assertEquals(49, len(WriteBehindDocument.index_keys_only("s", "behind")))
+    self.assertRaises(NotFoundError, WriteBehindDocument.get, "0")
+    self.assertEquals("behind", WriteBehindDocument.get("1").s)
+
+  def test_reads_see_queued_writes(self):
+    WriteBehindDocument("k", data={"s": "queued", "n": 5}).save()
+    WriteBehindDocument.update("k", inc={"n": 10})
+    self.assertEquals(15, WriteBehindDocument.get("k").n)
+
+    WriteBehindDocument("k", data={"s": "queued", "n": 1}).save()
+    WriteBehindDocument.delete_key("k")
+    WriteBehindDocument.write_behind.drain()
+    self.assertEquals([], WriteBehindDocument.index_keys_only("s", "queued"))
+    self.assertRaises(NotFoundError, WriteBehindDocument.get, "k")
+
+  def test_failing_on_error(self):
+    def on_error(e, batch):
+      raise ValueError("on_error failed")
+    write_behind = WriteBehind(on_error=on_error)
+
+    class FailingDB(object):
+      def Write(self, write_batch, sync=False):
+        raise leveldb.LevelDBError("disk on fire")
+
+    for i in xrange(2):
+      batch = Batch(WriteBehindDocument)
+      batch.put("key", "{}")
+      write_behind.put(batch, FailingDB())
+      self.assertRaises(ValueError, write_behind.drain)
+    write_behind.close()
+
+  def test_errors(self):
+    errors = []
+    write_behind = WriteBehind(on_error=lambda e, batch: errors.append((e, batch.keys)))
+
+    class FailingDB(object):
+      def Write(self, write_batch, sync=False):
+        raise leveldb.LevelDBError("disk on fire")
+
+    batch = Batch(WriteBehindDocument)
+    batch.put("key", "{}")
+    write_behind.put(batch, FailingDB())
+    write_behind.close()
+    self.assertEquals(1, len(errors))
+    self.assertEquals(["key"], errors[0][1])
+    self.assertRaises(DatabaseError, write_behind.put, batch)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import unittest
+import os.path
+
+from ..properties import *
+from ..document import Document
+from ..cache import LRUCache
+from ..exceptions import NotFoundError
+from ..backends import MemoryDB
+
+import leveldb
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+class CachedDocument(Document):
+  db = leveldb.LevelDB("{0}/test_cache.db".format(test_dir))
+  cache = LRUCache(max_entries=2)
+
+  s = StringProperty()
+  l = ListProperty()
+
+class RawCachedDocument(Document):
+  db = leveldb.LevelDB("{0}/test_cache_raw.db".format(test_dir))
+  cache = LRUCache(max_bytes=1024, decoded=False)
+
+  s = StringProperty()
+
+class RacingDB(MemoryDB):
+  """Runs race, once, between reading a value and returning it."""
+  race = None
+
+  def Get(self, key, *args, **kwargs):
+    value = MemoryDB.Get(self, key, *args, **kwargs)
+    race, self.race = self.race, None
+    if race is not None:
+      race()
+    return value
+
+class RacedDocument(Document):
+  db = RacingDB()
+  cache = LRUCache(max_entries=2)
+
+  s = StringProperty()
+
+class LRUCacheTest(unittest.TestCase):
+  def test_evicts_least_recently_used(self):
+    cache = LRUCache(max_entries=2)
+    cache.put("a", 1, 1)
+    cache.put("b", 2, 1)
+    self.assertEquals(1, cache.get("a"))
+    cache.put("c", 3, 1)
+
+    self.assertTrue("a" in cache)
+    self.assertFalse("b" in cache)
+    self.assertTrue("c" in cache)
+    self.assertEquals(1, cache.evictions)
+
+  def test_max_bytes(self):
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", 1, 6)
+    cache.put("b", 2, 6)
+    self.assertEquals(1, len(cache))
+    self.assertEquals(6, cache.stats()["bytes"])
+
+    cache.put("c", 3, 11)
+    self.assertFalse("c" in cache)
+
+  def test_counters(self):
+    cache = LRUCache(max_entries=2)
+    cache.put("a", 1, 1)
+    cache.get("a")
+    cache.get("b")
+    stats = cache.stats()
+    self.assertEquals(1, stats["hits"])
+    self.assertEquals(1, stats["misses"])
+    self.assertEquals(0.5, stats["hit_ratio"])
+
+    cache.reset_stats()
+    self.assertEquals(0, cache.hits)
+
+  def test_generations(self):
+    cache = LRUCache(max_entries=2)
+    generation = cache.generation("a")
+    cache.invalidate("a")
+    cache.put("a", 1, 1, generation)
+    self.assertFalse("a" in cache)
+
+    generation = cache.generation("a")
+    cache.invalidate("b")
+    cache.put("a", 1, 1, generation)
+    self.assertEquals(1, cache.get("a"))
+
+    generation = cache.generation("c")
+    cache.clear()
+    cache.put("c", 1, 1, generation)
+    self.assertFalse("c" in cache)
+
+  def test_requires_a_bound(self):
+    with self.assertRaises(ValueError):
+      LRUCache()
+
+class CachedDocumentTest(unittest.TestCase):
+  def setUp(self):
+    CachedDocument.cache.clear()
+    CachedDocument.cache.reset_stats()
+
+  def test_get_hits_cache(self):
+    doc = CachedDocument("a", data={"s": "meow", "l": [1, 2]}).save()
+
+    CachedDocument.get("a")
+    doc2 = CachedDocument.get("a")
+    self.assertEquals(1, CachedDocument.cache.hits)
+    self.assertEquals("meow", doc2.s)
+
+    # Mutating a document must not affect the cached copy.
+    doc2.l.append(3)
+    self.assertEquals([1, 2], CachedDocument.get("a").l)
+    doc.delete()
+
+  def test_save_and_delete_invalidate(self):
+    doc = CachedDocument("b", data={"s": "meow"}).save()
+    CachedDocument.get("b")
+
+    doc.s = "quack"
+    doc.save()
+    self.assertEquals("quack", CachedDocument.get("b").s)
+
+    CachedDocument.delete_key("b", batch=True)
+    self.assertEquals("quack", CachedDocument.get("b").s)
+    CachedDocument.flush()
+    with self.assertRaises(NotFoundError):
+      CachedDocument.get("b")
+
+  def test_write_during_a_read(self):
+    doc = RacedDocument("a", data={"s": "before"}).save()
+    def write():
+      doc.s = "after"
+      doc.save()
+    RacedDocument.db.race = write
+
+    self.assertEquals("before", RacedDocument.get("a").s)
+    self.assertEquals("after", RacedDocument.get("a").s)
+
+  def test_raw_values(self):
+    doc = RawCachedDocument("c", data={"s": "meow"}).save()
+    RawCachedDocument.get("c")
+    self.assertEquals("meow", RawCachedDocument.get("c").s)
+    self.assertEquals(1, RawCachedDocument.cache.hits)
+    doc.delete()
+    with self.assertRaises(NotFoundError):
+      RawCachedDocument.get("c")
+
+if __name__ == "__main__":
+  unittest.main()
@@ -18,10 +18,14 @@ from __future__ import absolute_import
 
 import unittest
 import os.path
+import time
+import warnings
 
 from ..properties import *
 from ..document import Document, EmDocument
-from ..exceptions import NotFoundError
+from ..exceptions import NotFoundError, DatabaseError, ValidationError
+from ..backends import MemoryDB
+from .. import handles
 
 import json
 import leveldb
@@ -50,6 +54,7 @@ class DocumentWithRef(Document):
   db = leveldb.LevelDB("{0}/test2.db".format(test_dir))
 
   ref = ReferenceProperty(SomeDocument)
+  lazy_ref = ReferenceProperty(SomeDocument, lazy=True)
 
 class DocumentDbOnDemand(Document):
   db = "{0}/test3.db".format(test_dir)
@@ -57,6 +62,21 @@ class DocumentDbOnDemand(Document):
 
   test = StringProperty()
 
+class PooledDocument(Document):
+  db = "{0}/test_pool.db".format(test_dir)
+  OPEN_ONLY_WHEN_NEEDED = True
+  HANDLE_IDLE_TIMEOUT = 0.05
+
+  test = StringProperty()
+
+class OtherPooledDocument(PooledDocument):
+  pass
+
+class OptionsDocument(Document):
+  db = "{0}/test_options.db".format(test_dir)
+  OPEN_ONLY_WHEN_NEEDED = True
+  db_options = {"block_cache_size": 1 << 20, "write_buffer_size": 1 << 20, "bloom_filter_bits": 10}
+
 class DocumentLater(Document):
   db = "{0}/test3.db".format(test_dir)
 
@@ -68,6 +88,34 @@ class DocumentWithMixin(Document, Mixin):
   db = leveldb.LevelDB("{0}/mixin.db".format(test_dir))
   indexdb = leveldb.LevelDB("{0}/test_mixin_index.db".format(test_dir))
 
+def _square(doc):
+  return doc.test_number_index ** 2
+
+class CountingDB(object):
+  def __init__(self, db):
+    self.db = db
+    self.writes = 0
+    # The number of the next writes that fail.
+    self.failures = 0
+
+  def Write(self, write_batch, sync=False):
+    if self.failures > 0:
+      self.failures -= 1
+      raise IOError("Write failed.")
+    self.writes += 1
+    return self.db.Write(write_batch, sync=sync)
+
+  def __getattr__(self, name):
+    return getattr(self.db, name)
+
+class TrackedDocument(Document):
+  db = CountingDB(leveldb.LevelDB("{0}/test_tracked.db".format(test_dir)))
+  indexdb = leveldb.LevelDB("{0}/test_tracked_index.db".format(test_dir))
+
+  s = StringProperty(index=True)
+  l = ListProperty(index=True)
+  d = DictProperty()
+
 class BasicDocumentTest(unittest.TestCase):
   def setUp(self):
     if not hasattr(self, "cleanups"):
@@ -160,6 +208,242 @@ class BasicDocumentTest(unittest.TestCase):
     self.assertEquals(doc2.key, doc2_copy.key)
     self.assertEquals(doc.key, doc2_copy.ref.key)
 
+  def test_reference_is_lazy(self):
+    doc = SomeDocument()
+    doc.test_str_index = "lazy"
+    doc.save()
+    self.cleanups.append(doc)
+
+    doc2 = DocumentWithRef()
+    doc2.ref = doc
+    doc2.lazy_ref = doc
+    doc2.save()
+    self.cleanups.append(doc2)
+
+    doc2_copy = DocumentWithRef.get(doc2.key)
+    self.assertFalse(doc2_copy.ref._pending_load)
+    self.assertTrue(doc2_copy.lazy_ref._pending_load)
+    self.assertEquals("lazy", doc2_copy.lazy_ref.test_str_index)
+    self.assertFalse(doc2_copy.lazy_ref._pending_load)
+
+  def test_missing_reference(self):
+    doc = DocumentWithRef(data={"ref": SomeDocument("nothere"), "lazy_ref": SomeDocument("nothere")}).save()
+    self.cleanups.append(doc)
+
+    doc = DocumentWithRef.get(doc.key)
+    self.assertEquals(None, doc.ref)
+    with self.assertRaises(NotFoundError):
+      doc.lazy_ref.test_str_index
+
+  def test_get_many(self):
+    doc = SomeDocument().save()
+    doc2 = SomeDocument().save()
+    self.cleanups.extend([doc, doc2])
+
+    docs = SomeDocument.get_many([doc.key, doc2.key, doc.key, "nothere"])
+    self.assertEquals(2, len(docs))
+    self.assertEquals(doc.key, docs[doc.key].key)
+    self.assertEquals(doc2.key, docs[doc2.key].key)
+
+  def test_prefetch_related(self):
+    doc = SomeDocument()
+    doc.test_str_index = "prefetched"
+    doc.save()
+    self.cleanups.append(doc)
+
+    refs = [DocumentWithRef(data={"lazy_ref": doc}).save() for i in xrange(3)]
+    missing = DocumentWithRef(data={"lazy_ref": SomeDocument("nothere")}).save()
+    self.cleanups.extend(refs)
+    self.cleanups.append(missing)
+
+    docs = DocumentWithRef.get_many([d.key for d in refs + [missing]]).values()
+    DocumentWithRef.prefetch_related(docs, "lazy_ref")
+    for d in docs:
+      if d == missing:
+        self.assertEquals(None, d.lazy_ref)
+      else:
+        self.assertFalse(d.lazy_ref._pending_load)
+        self.assertEquals("prefetched", d.lazy_ref.test_str_index)
+
+    with self.assertRaises(ValueError):
+      DocumentWithRef.prefetch_related(docs, "notaref")
+
+  def test_partial_load(self):
+    doc = SomeDocument()
+    doc.test_str_index = "partial"
+    doc.test_number_index = 42
+    doc.extra = "extra"
+    doc.save()
+    self.cleanups.append(doc)
+
+    partial = SomeDocument.get(doc.key, fields=["test_str_index", "test_list_index"])
+    self.assertEquals("partial", partial.test_str_index)
+    self.assertEquals([], partial.test_list_index)
+    with self.assertRaises(AttributeError):
+      partial.test_number_index
+    with self.assertRaises(AttributeError):
+      partial.extra
+    with self.assertRaises(AttributeError):
+      partial.test_str_index = "nope"
+    with self.assertRaises(DatabaseError):
+      partial.save()
+
+    partial.reload()
+    self.assertEquals(42, partial.test_number_index)
+    partial.test_str_index = "partial"
+
+    docs = list(SomeDocument.index("test_str_index", "partial", fields=["test_number_index"]))
+    self.assertEquals(1, len(docs))
+    self.assertEquals(42, docs[0].test_number_index)
+    with self.assertRaises(AttributeError):
+      docs[0].test_str_index
+
+  def test_snapshot(self):
+    doc = SomeDocument()
+    doc.test_str_index = "before"
+    doc.save()
+    self.cleanups.append(doc)
+
+    with SomeDocument.snapshot():
+      doc.test_str_index = "after"
+      doc.save()
+      other = SomeDocument().save()
+      self.cleanups.append(other)
+
+      self.assertEquals("before", SomeDocument.get(doc.key).test_str_index)
+      self.assertEquals([doc.key], SomeDocument.index_keys_only("test_str_index", "before"))
+      self.assertEquals([], SomeDocument.index_keys_only("test_str_index", "after"))
+      self.assertFalse(other.key in SomeDocument.index_keys_only("$bucket", None))
+      self.assertEquals(1, len(SomeDocument.get_many([doc.key, other.key])))
+      with SomeDocument.snapshot():
+        self.assertEquals("before", list(SomeDocument.index("test_str_index", "before"))[0].test_str_index)
+
+    self.assertEquals("after", SomeDocument.get(doc.key).test_str_index)
+    self.assertTrue(other.key in SomeDocument.index_keys_only("$bucket", None))
+
+  def test_unchanged_save_is_skipped(self):
+    doc = TrackedDocument(data={"s": "a", "l": ["x"]}).save()
+    writes = TrackedDocument.db.writes
+
+    doc.save()
+    loaded = TrackedDocument.get(doc.key)
+    # doc is stale once loaded is saved.
+    self.cleanups.append(loaded)
+    loaded.save()
+    loaded.s = "a"
+    loaded.save()
+    self.assertEquals(writes, TrackedDocument.db.writes)
+
+    loaded.s = "b"
+    loaded.save()
+    self.assertEquals(writes + 1, TrackedDocument.db.writes)
+    self.assertEquals([doc.key], TrackedDocument.index_keys_only("s", "b"))
+    self.assertEquals([], TrackedDocument.index_keys_only("s", "a"))
+
+    # Changes made in place are picked up too.
+    loaded.l.append("y")
+    loaded.d["k"] = "v"
+    loaded.save()
+    self.assertEquals(writes + 2, TrackedDocument.db.writes)
+    self.assertEquals([doc.key], TrackedDocument.index_keys_only("l", "y"))
+    self.assertEquals({"k": "v"}, TrackedDocument.get(doc.key).d)
+
+    loaded.extra = 1
+    loaded.save()
+    del loaded.extra
+    loaded.save()
+    self.assertEquals(writes + 4, TrackedDocument.db.writes)
+    self.assertFalse("extra" in TrackedDocument.get(doc.key)._data)
+
+  def test_load_copies_only_containers(self):
+    doc = TrackedDocument(data={"s": "a", "l": ["x"]}).save()
+    self.cleanups.append(doc)
+    data = json.loads(TrackedDocument.db.Get(doc.key))
+    loaded = TrackedDocument(doc.key).deserialize(data)
+    self.assertEquals(data, loaded._clean)
+    self.assertFalse(loaded._clean["l"] is loaded.l)
+    self.assertFalse(loaded._clean is data)
+
+    del data["l"], data["d"]
+    loaded = TrackedDocument(doc.key).deserialize(data)
+    self.assertTrue(loaded._clean is data)
+
+  def test_unchanged_save_is_written_when_not_stored(self):
+    loaded = TrackedDocument.get(TrackedDocument(data={"s": "a"}).save().key)
+    self.cleanups.append(loaded)
+
+    # Another db.
+    other = MemoryDB()
+    loaded.save(db=other)
+    self.assertEquals("a", json.loads(other.Get(loaded.key))["s"])
+
+    # Deleted since it was loaded.
+    TrackedDocument.delete_key(loaded.key)
+    loaded.save()
+    self.assertEquals("a", TrackedDocument.get(loaded.key).s)
+    self.assertEquals([loaded.key], TrackedDocument.index_keys_only("s", "a"))
+
+    # Failed or discarded writes.
+    loaded.s = "b"
+    TrackedDocument.db.failures = 1
+    self.assertRaises(IOError, loaded.save)
+    loaded.save()
+    self.assertEquals("b", TrackedDocument.get(loaded.key).s)
+
+    loaded.s = "c"
+    with self.assertRaises(ValueError):
+      with TrackedDocument.batch():
+        loaded.save(batch=True)
+        raise ValueError
+    loaded.save()
+    self.assertEquals("c", TrackedDocument.get(loaded.key).s)
+    self.assertEquals([], TrackedDocument.index_keys_only("s", "b"))
+    self.assertEquals([loaded.key], TrackedDocument.index_keys_only("s", "c"))
+
+  def test_update(self):
+    doc = SomeDocument(data={"test_str_index": "before", "test_number_index": 100, "test_list_index": ["a"]}).save()
+
+    data = SomeDocument.update(doc.key, set={"test_str_index": "after"}, inc={"test_number_index": 2}, push={"test_list_index": "b"})
+    self.assertEquals("after", data["test_str_index"])
+    self.assertEquals(102, data["test_number_index"])
+
+    SomeDocument.update(doc.key, pull={"test_list_index": "a"})
+    loaded = SomeDocument.get(doc.key)
+    self.assertEquals(["b"], loaded.test_list_index)
+    self.assertEquals([], SomeDocument.index_keys_only("test_str_index", "before"))
+    self.assertEquals([doc.key], SomeDocument.index_keys_only("test_str_index", "after"))
+    self.assertEquals([doc.key], SomeDocument.index_keys_only("test_number_index", 102))
+    self.assertEquals([], SomeDocument.index_keys_only("test_list_index", "a"))
+    self.assertEquals([doc.key], SomeDocument.index_keys_only("test_list_index", "b"))
+
+    self.assertRaises(NotFoundError, SomeDocument.update, "nope", inc={"test_number_index": 1})
+    self.assertEquals(1, SomeDocument.update_many([doc.key, "nope"], inc={"test_number_index": 1}))
+    self.assertEquals([doc.key], SomeDocument.index_keys_only("test_number_index", 103))
+
+    SomeDocument.delete_key(doc.key)
+    self.assertEquals([], SomeDocument.index_keys_only("test_list_index", "b"))
+
+  def test_update_validates(self):
+    doc = SimpleDocument(data={"s": "a", "i": 1, "l": ["x"], "sr": "r"}).save()
+    self.cleanups.append(doc)
+
+    self.assertRaises(ValidationError, SimpleDocument.update, doc.key, inc={"s": 1})
+    self.assertRaises(ValidationError, SimpleDocument.update, doc.key, inc={"i": "1"})
+    self.assertRaises(ValidationError, SimpleDocument.update, doc.key, push={"s": "b"})
+    self.assertRaises(ValidationError, SimpleDocument.update, doc.key, pull={"i": 1})
+    self.assertRaises(ValidationError, SimpleDocument.update, doc.key, set={"sv": "invalid"})
+    self.assertRaises(ValidationError, SimpleDocument.update, doc.key, set={"sr": None})
+    self.assertRaises(ValidationError, SimpleDocument.update_many, [doc.key], inc={"s": 1})
+
+    loaded = SimpleDocument.get(doc.key)
+    self.assertEquals("a", loaded.s)
+    self.assertEquals(1, loaded.i)
+    self.assertEquals(["x"], loaded.l)
+
+    data = SimpleDocument.update(doc.key, inc={"i": 1}, push={"l": "y"})
+    self.assertEquals(2, data["i"])
+    self.assertEquals(["x", "y"], data["l"])
+
   def test_2i_save_delete(self):
     doc = SomeDocument()
     doc.test_str_index = "meow"
@@ -265,6 +549,15 @@ class BasicDocumentTest(unittest.TestCase):
 
     self.assertEquals(2, counter)
 
+  def test_2i_keys_only_range(self):
+    doc = SomeDocument()
+    doc.test_list_index = ["ranged1", "ranged2"]
+    doc.save()
+    self.cleanups.append(doc)
+
+    keys = SomeDocument.index_keys_only("test_list_index", "ranged1", "ranged2")
+    self.assertEquals([doc.key, doc.key], keys)
+
   def test_db_load_ondemand(self):
     doc = DocumentDbOnDemand()
     db = leveldb.LevelDB(DocumentDbOnDemand.db)
@@ -278,6 +571,61 @@ class BasicDocumentTest(unittest.TestCase):
     db = leveldb.LevelDB(DocumentDbOnDemand.db)
     del db
 
+  def test_db_handle_pool(self):
+    doc = PooledDocument(data={"test": "pooled"}).save()
+    self.assertTrue(PooledDocument.db in handles.pool)
+    self.assertTrue(PooledDocument._get_db() is OtherPooledDocument._get_db())
+    self.assertEquals("pooled", OtherPooledDocument.get(doc.key).test)
+
+    # Not closed while in use.
+    with PooledDocument.snapshot():
+      time.sleep(0.1)
+      handles.pool.close_idle()
+      self.assertTrue(PooledDocument.db in handles.pool)
+
+    time.sleep(0.1)
+    handles.pool.close_idle()
+    self.assertFalse(PooledDocument.db in handles.pool)
+    db = leveldb.LevelDB(PooledDocument.db)
+    del db
+    PooledDocument.delete_key(doc.key)
+
+  def test_db_handle_reaper(self):
+    pool = handles.HandlePool()
+    calls = []
+    close_idle = pool.close_idle
+    def counting_close_idle():
+      calls.append(1)
+      return close_idle()
+    pool.close_idle = counting_close_idle
+
+    path = "{0}/test_reaper.db".format(test_dir)
+    # A database closed as soon as it is not in use and one in use do not
+    # make the reaper spin.
+    lease = pool.get("{0}/test_reaper_now.db".format(test_dir))
+    other = pool.get(path, 0.2)
+    try:
+      time.sleep(0.3)
+      self.assertTrue(len(calls) < 3)
+      self.assertTrue(path in pool)
+
+      del other
+      time.sleep(0.5)
+      self.assertFalse(path in pool)
+    finally:
+      pool._stop_reaper()
+    del lease
+
+  def test_db_options(self):
+    with warnings.catch_warnings(record=True) as caught:
+      warnings.simplefilter("always")
+      doc = OptionsDocument(data={"a": 1}).save()
+      self.assertEquals(1, OptionsDocument.get(doc.key).a)
+      OptionsDocument.delete_key(doc.key)
+
+    self.assertTrue(len(caught) > 0)
+    self.assertTrue("bloom_filter_bits" in str(caught[0].message))
+
   def test_establish_db_connection_later(self):
     DocumentLater.establish_connection()
     self.assertTrue(isinstance(DocumentLater.db, leveldb.LevelDB))
@@ -306,6 +654,31 @@ class BasicDocumentTest(unittest.TestCase):
     serialized = doc.serialize(expand=[{}])
     self.assertTrue(isinstance(serialized["ref"], dict))
 
+  def test_serialize_expand_batched(self):
+    doc = SomeDocument()
+    doc.test_str_index = "expanded"
+    doc.save()
+    self.cleanups.append(doc)
+
+    refs = [DocumentWithRef(data={"ref": doc}).save() for i in xrange(3)]
+    self.cleanups.extend(refs)
+
+    docs = DocumentWithRef.get_many([d.key for d in refs]).values()
+    expand = [{"include_key": True}]
+    serialized = DocumentWithRef.serialize_many(docs, expand=expand)
+    self.assertEquals(1, len(expand))
+    self.assertEquals(3, len(serialized))
+    for d in serialized:
+      self.assertEquals(doc.key, d["ref"]["key"])
+      self.assertEquals("expanded", d["ref"]["test_str_index"])
+    # The same reference is only serialized once, but not shared.
+    self.assertFalse(serialized[0]["ref"] is serialized[1]["ref"])
+    serialized[0]["ref"]["test_str_index"] = "changed"
+    self.assertEquals("expanded", serialized[1]["ref"]["test_str_index"])
+
+    serialized = docs[0].serialize(expand=[{"dictionary": False}])
+    self.assertEquals("expanded", json.loads(serialized["ref"])["test_str_index"])
+
   def test_equal(self):
     doc = SomeDocument("test")
     doc_same = SomeDocument("test")
@@ -335,6 +708,49 @@ class BasicDocumentTest(unittest.TestCase):
 
     self.assertEquals(5, i)
 
+  def test_scan(self):
+    for i in xrange(1, 6):
+      self.cleanups.append(SomeDocument("scan{0}".format(i), data={"test_str_index": "scanned"}).save())
+
+    keys = [doc.key for doc in SomeDocument.scan("scan2", "scan4")]
+    self.assertEquals(["scan2", "scan3", "scan4"], keys)
+
+    docs = list(SomeDocument.scan("scan1", "scan5", fields=["test_str_index"]))
+    self.assertEquals(["scan1", "scan2", "scan3", "scan4", "scan5"], [doc.key for doc in docs])
+    for doc in docs:
+      self.assertEquals("scanned", doc.test_str_index)
+
+  def test_iter_range(self):
+    for key in ("a1", "a2", "a3", "b1", "b2"):
+      DocumentWithRef(key).save()
+
+    keys = lambda **kwargs: list(DocumentWithRef.iter_range(keys_only=True, **kwargs))
+    self.assertEquals(["a1", "a2", "a3"], keys(prefix="a"))
+    self.assertEquals(["a3", "a2", "a1"], keys(prefix="a", reverse=True))
+    self.assertEquals(["b2", "b1"], keys(prefix="b", reverse=True))
+    self.assertEquals(["a2", "a3"], keys(prefix="a", start="a2"))
+    self.assertEquals(["a1", "a2"], keys(prefix="a", limit=2))
+    self.assertEquals(["a3", "b1"], keys(start="a3", end="b1"))
+    self.assertEquals(["b2"], keys(reverse=True, limit=1))
+
+    docs = list(DocumentWithRef.iter_range(prefix="b"))
+    self.assertEquals(["b1", "b2"], [doc.key for doc in docs])
+    self.assertFalse(docs[0]._pending_load)
+
+    docs = list(DocumentWithRef.iter_range(prefix="b", include_value=False))
+    self.assertTrue(docs[0]._pending_load)
+
+    for key in ("a1", "a2", "a3", "b1", "b2"):
+      DocumentWithRef.delete_key(key, batch=True)
+    DocumentWithRef.flush()
+
+  def test_parallel_map(self):
+    for i in xrange(1, 6):
+      self.cleanups.append(SomeDocument("map{0}".format(i), data={"test_number_index": i}).save())
+
+    self.assertEquals([4, 9, 16], SomeDocument.parallel_map(_square, workers=2, start="map2", end="map4", chunk_size=2))
+    self.assertEquals([1, 4, 9, 16, 25], SomeDocument.parallel_map(_square, workers=2, start="map1", end="map5"))
+
   def test_set_key(self):
     doc = SomeDocument()
     k = doc.key
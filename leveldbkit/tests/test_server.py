@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import unittest
+import multiprocessing
+import os
+import os.path
+import socket
+import tempfile
+import threading
+
+from ..properties import *
+from ..document import Document
+from ..server import Server, Client
+from ..exceptions import NotFoundError, DatabaseError
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+socket_path = os.path.join(tempfile.gettempdir(), "leveldbkit-test-{0}.sock".format(os.getpid()))
+
+server = None
+client = Client(socket_path)
+
+class RemoteDocument(Document):
+  db = client.database("docs")
+  indexdb = client.database("index")
+
+  s = StringProperty(index=True)
+
+class SubRemoteDocument(RemoteDocument):
+  pass
+
+def _save_many(prefix):
+  for i in xrange(50):
+    RemoteDocument(prefix + str(i), data={"s": "processes"}).save()
+
+def setUpModule():
+  global server
+  server = Server(socket_path, {
+    "docs": "{0}/test_server.db".format(test_dir),
+    "index": "{0}/test_server_index.db".format(test_dir),
+  })
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+
+def tearDownModule():
+  server.shutdown()
+  server.server_close()
+  os.unlink(socket_path)
+
+class ServerTest(unittest.TestCase):
+  def tearDown(self):
+    RemoteDocument.delete_range()
+
+  def test_documents(self):
+    doc = RemoteDocument("a", data={"s": "remote"}).save()
+    self.assertEquals("remote", RemoteDocument.get("a").s)
+    self.assertEquals(["a"], RemoteDocument.index_keys_only("s", "remote"))
+    self.assertRaises(NotFoundError, RemoteDocument.get, "nope")
+
+    RemoteDocument("b", data={"s": "remote"}).save()
+    docs = RemoteDocument.get_many(["b", "a", "nope"])
+    self.assertEquals(["a", "b"], sorted(docs.keys()))
+
+    doc.delete()
+    self.assertEquals(["b"], RemoteDocument.index_keys_only("s", "remote"))
+
+  def test_range_chunks_and_snapshots(self):
+    with RemoteDocument.batch():
+      for i in xrange(25):
+        RemoteDocument("k{0:02d}".format(i), data={"s": "range"}).save(batch=True)
+
+    keys = ["k{0:02d}".format(i) for i in xrange(25)]
+    RemoteDocument.db.RANGE_CHUNK_SIZE = 4
+    try:
+      self.assertEquals(keys, list(RemoteDocument.iter_range(keys_only=True)))
+      self.assertEquals(list(reversed(keys)), list(RemoteDocument.iter_range(reverse=True, keys_only=True)))
+      self.assertEquals(keys[3:9], [doc.key for doc in RemoteDocument.iter_range("k03", "k08")])
+    finally:
+      del RemoteDocument.db.RANGE_CHUNK_SIZE
+
+    with RemoteDocument.snapshot():
+      RemoteDocument.delete_key("k00")
+      self.assertEquals(keys, RemoteDocument.index_keys_only("$bucket", None))
+    self.assertEquals(keys[1:], RemoteDocument.index_keys_only("$bucket", None))
+
+  def test_pipelined_threads(self):
+    def save(cls, prefix):
+      for i in xrange(20):
+        cls(prefix + str(i), data={"s": "threads"}).save()
+
+    # The subclass shares the lock of the indexdb with its parent.
+    threads = [threading.Thread(target=save, args=(SubRemoteDocument if i % 2 else RemoteDocument, p)) for i, p in enumerate("abcd")]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join(10)
+      self.assertFalse(thread.is_alive())
+
+    self.assertEquals(80, len(RemoteDocument.index_keys_only("s", "threads")))
+
+  def test_waiting_for_the_lock(self):
+    RemoteDocument("a", data={"s": "before"}).save()
+    other = Client(socket_path).database("index")
+    other.lock()
+    other.lock()
+
+    thread = threading.Thread(target=RemoteDocument.update, args=("a", ), kwargs={"set": {"s": "after"}})
+    thread.start()
+    thread.join(0.1)
+    self.assertTrue(thread.is_alive())
+    # The connection still answers the other threads in the meantime.
+    self.assertEquals("before", RemoteDocument.get("a").s)
+
+    other.unlock()
+    thread.join(0.1)
+    self.assertTrue(thread.is_alive())
+    other.unlock()
+    thread.join(10)
+    self.assertFalse(thread.is_alive())
+    self.assertEquals("after", RemoteDocument.get("a").s)
+
+  def test_processes(self):
+    processes = [multiprocessing.Process(target=_save_many, args=(p, )) for p in "abcd"]
+    for process in processes:
+      process.start()
+    for process in processes:
+      process.join()
+
+    self.assertEquals([0] * 4, [process.exitcode for process in processes])
+    self.assertEquals(200, len(RemoteDocument.index_keys_only("s", "processes")))
+
+  def test_socket_in_use(self):
+    self.assertRaises(DatabaseError, Server, socket_path, {})
+    self.assertTrue(os.path.exists(socket_path))
+    # Still served.
+    RemoteDocument("a", data={"s": "remote"}).save()
+    self.assertEquals("remote", RemoteDocument.get("a").s)
+
+    # Left over by a server that is gone.
+    path = socket_path + ".stale"
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.close()
+    stale = Server(path, {})
+    stale.server_close()
+    os.unlink(path)
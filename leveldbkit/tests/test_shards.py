@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import unittest
+import os.path
+
+from ..properties import *
+from ..document import Document
+from ..shards import ShardedDB
+from ..exceptions import NotFoundError
+from .. import handles
+
+import leveldb
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+class ShardedDocument(Document):
+  shards = ["{0}/test_shard{1}.db".format(test_dir, i) for i in xrange(3)]
+  indexdb = leveldb.LevelDB("{0}/test_shards_index.db".format(test_dir))
+
+  s = StringProperty(index=True)
+
+class LazyShardedDocument(Document):
+  shards = ["{0}/test_lazy_shard{1}.db".format(test_dir, i) for i in xrange(3)]
+  indexdb = "{0}/test_lazy_shards_index.db".format(test_dir)
+  OPEN_ONLY_WHEN_NEEDED = True
+
+  s = StringProperty(index=True)
+
+class ShardTest(unittest.TestCase):
+  def setUp(self):
+    with ShardedDocument.batch():
+      for i in xrange(30):
+        ShardedDocument("k{0:02d}".format(i), data={"s": "even" if i % 2 == 0 else "odd"}).save(batch=True)
+
+  def tearDown(self):
+    ShardedDocument.delete_range()
+
+  def test_routing(self):
+    self.assertTrue(isinstance(ShardedDocument.db, ShardedDB))
+    for shard in ShardedDocument.db.shards:
+      keys = list(shard.RangeIter(include_value=False))
+      self.assertTrue(0 < len(keys) < 30)
+      for key in keys:
+        self.assertEquals(shard, ShardedDocument.db.shards[ShardedDocument.db.shard_of(key)])
+
+    self.assertEquals("odd", ShardedDocument.get("k03").s)
+    ShardedDocument.get("k03").delete()
+    self.assertRaises(NotFoundError, ShardedDocument.get, "k03")
+    self.assertEquals(14, len(ShardedDocument.index_keys_only("s", "odd")))
+
+  def test_merged_iteration(self):
+    keys = ["k{0:02d}".format(i) for i in xrange(30)]
+    self.assertEquals(keys, ShardedDocument.index_keys_only("$bucket", None))
+    self.assertEquals(keys[5:11], list(ShardedDocument.iter_range("k05", "k10", keys_only=True)))
+    self.assertEquals(list(reversed(keys))[:4], list(ShardedDocument.iter_range(reverse=True, limit=4, keys_only=True)))
+    self.assertEquals(keys, [doc.key for doc in ShardedDocument.scan()])
+
+    with ShardedDocument.snapshot():
+      ShardedDocument.delete_key("k00")
+      self.assertEquals(keys, ShardedDocument.index_keys_only("$bucket", None))
+    self.assertEquals(keys[1:], ShardedDocument.index_keys_only("$bucket", None))
+
+  def test_open_only_when_needed(self):
+    self.assertFalse(any(path in handles.pool for path in LazyShardedDocument.shards))
+    with LazyShardedDocument.batch():
+      for i in xrange(10):
+        LazyShardedDocument(str(i), data={"s": "lazy"}).save(batch=True)
+
+    self.assertEquals("lazy", LazyShardedDocument.get("3").s)
+    self.assertEquals([str(i) for i in xrange(10)], sorted(LazyShardedDocument.index_keys_only("s", "lazy")))
+    self.assertEquals(10, LazyShardedDocument.delete_range())
+    self.assertFalse(any(path in handles.pool for path in LazyShardedDocument.shards))
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# This file is part of Riakkit or Leveldbkit
+#
+# Riakkit or Leveldbkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Riakkit or Leveldbkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Riakkit or Leveldbkit. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from Queue import Queue, Empty
+from threading import Thread, Lock, Condition
+
+from .batch import merge_checked
+from .exceptions import DatabaseError
+
+_STOP = object()
+
+class WriteBehind(object):
+  """Writes the documents of a class from a background thread.
+
+  Assign an instance of this to the `write_behind` class variable of a
+  Document subclass. `save`, `delete` and the other writes that are not
+  batch=True then only serialize the document and queue the resulting batch
+  (the values and the index changes). A background thread takes the queued
+  batches, merges up to `max_batch_ops` operations of them and writes them
+  together, so the writing thread never waits for leveldb.
+
+  The queue is bounded: once `max_queue` batches are waiting, writers block
+  until the background thread catches up.
+
+  Queued writes are not visible to reads until they are written. Call
+  `drain` to wait for them and `close` before the process exits, or the
+  writes still queued are lost. The writes of the class that read the stored
+  documents first (`update`, `update_many`, `mutate`, `delete_key`,
+  `delete_where` and `delete_range`) wait for the writes queued before them
+  with `wait`, so they never work on stale values.
+
+  Each class should have its own instance.
+  """
+
+  def __init__(self, max_queue=1000, max_batch_ops=10000, sync=False, on_error=None):
+    """Initializes a write behind queue. The background thread is started on
+    the first write.
+
+    Args:
+      max_queue: The maximum number of batches waiting to be written.
+                 Defaults to 1000.
+      max_batch_ops: The number of operations after which the background
+                     thread stops merging queued batches and writes.
+                     Defaults to 10000.
+      sync: sync argument to pass to leveldb for the background writes. The
+            sync argument of the writes themselves is ignored. Defaults to
+            False.
+      on_error: A function called from the background thread with the
+                exception and the Batch that failed to be written (the
+                batches that conflicted are reported one by one, the other
+                errors with all the batches written together). The
+                documents of the batch are rolled back (see `Batch.writing`)
+                before it is called. If None, or if on_error raises, the
+                first error is raised by the next `drain` instead. Defaults
+                to None.
+    """
+    self.max_batch_ops = max_batch_ops
+    self.sync = sync
+    self.on_error = on_error
+
+    self._queue = Queue(max_queue)
+    self._lock = Lock()
+    self._thread = None
+    self._closed = False
+    self._error = None
+    # The number of batches queued and written so far, for wait.
+    self._done = Condition(Lock())
+    self._queued = 0
+    self._written = 0
+
+  def put(self, batch, db=None):
+    """Queues a batch to be written, blocking while the queue is full.
+
+    Args:
+      batch: the Batch to write. It is owned by the queue from now on.
+      db: The db to write the documents to. Defaults to the class db.
+    Raises:
+      DatabaseError if the queue is closed.
+    """
+    with self._lock:
+      if self._closed:
+        raise DatabaseError("The write behind queue is closed.")
+      if self._thread is None:
+        self._thread = Thread(target=self._run, name="leveldbkit-write-behind")
+        self._thread.daemon = True
+        self._thread.start()
+
+    with self._done:
+      self._queued += 1
+    self._queue.put((batch, db))
+
+  def __len__(self):
+    return self._queue.qsize()
+
+  def _run(self):
+    pending = None
+    while True:
+      item = pending or self._queue.get()
+      pending = None
+      if item is _STOP:
+        self._queue.task_done()
+        return
+
+      batches, db = [item[0]], item[1]
+      ops = len(item[0])
+      # Take whatever else is already waiting, as long as it goes to the same
+      # db.
+      while ops < self.max_batch_ops:
+        try:
+          item = self._queue.get_nowait()
+        except Empty:
+          break
+        if item is _STOP or item[1] is not db:
+          pending = item
+          break
+        batches.append(item[0])
+        ops += len(item[0])
+
+      try:
+        self._write(batches, db)
+      except Exception, e:
+        # Nothing was written.
+        for batch in batches:
+          batch.clear()
+        self._record(e)
+      finally:
+        for i in xrange(len(batches)):
+          self._queue.task_done()
+        with self._done:
+          self._written += len(batches)
+          self._done.notify_all()
+
+  def _write(self, batches, db):
+    cls = batches[0].document_class
+    with cls._write_lock:
+      merged, conflicts = merge_checked(cls, batches, db)
+      for batch, error in conflicts.iteritems():
+        self._failed(error, batch)
+
+      try:
+        merged.flush(self.sync, db)
+      except Exception, e:
+        self._failed(e, merged)
+
+  def _failed(self, error, batch):
+    batch._rollback_documents()
+    if self.on_error is not None:
+      try:
+        self.on_error(error, batch)
+        return
+      except Exception, e:
+        error = e
+    self._record(error)
+
+  def _record(self, error):
+    if self._error is None:
+      self._error = error
+
+  def wait(self):
+    """Waits until the batches queued so far are written (or failed to be),
+    without raising their errors like `drain` does. Batches queued while
+    waiting are not waited for."""
+    with self._done:
+      queued = self._queued
+      while self._written < queued:
+        self._done.wait()
+
+  def drain(self):
+    """Waits until everything queued so far is written.
+
+    Raises:
+      The first error raised by a background write since the last drain,
+      if there is no on_error.
+    """
+    self._queue.join()
+    error, self._error = self._error, None
+    if error is not None:
+      raise error
+
+  def close(self):
+    """Writes everything queued and stops the background thread. Writing to
+    the class afterwards raises DatabaseError.
+
+    Raises:
+      See `drain`.
+    """
+    with self._lock:
+      if self._closed:
+        return
+      self._closed = True
+      thread = self._thread
+
+    if thread is not None:
+      self._queue.put(_STOP)
+      thread.join()
+    self.drain()